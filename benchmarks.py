@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+"""
+Times the rating, aggregation and similarity code paths on a synthetic set of
+ratings in SQLite, and writes the wall times and query counts as JSON so runs
+from different commits can be compared:
+
+    python benchmarks.py --output before.json
+    git checkout some-branch
+    python benchmarks.py --output after.json --compare before.json
+
+The ratings are generated from a seed, so runs with the same options rate the
+same items.  Item popularity follows a power law, a few items collect most of
+the ratings like on a real site.
+"""
+import bisect
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+import django
+
+from os.path import dirname, abspath
+
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': '',
+            }
+        },
+        INSTALLED_APPS = [
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'ratings',
+            'ratings.ratings_tests',
+        ],
+    )
+
+sys.path.insert(0, dirname(abspath(__file__)))
+
+try:
+    from django import setup
+    setup()
+except ImportError:
+    pass
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, reset_queries
+
+from ratings.models import RatedItem
+from ratings.ratings_tests.models import Food, Snack
+from ratings.utils import calculate_similar_items, chunked, \
+    recommendations, recommended_items, top_matches
+
+
+def parse_args():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--users', type='int', default=1000,
+        help='Number of users rating items')
+    parser.add_option('--items', type='int', default=5000,
+        help='Number of rated items')
+    parser.add_option('--ratings-per-user', type='int', default=20,
+        help='Number of items each user rates')
+    parser.add_option('--skew', type='float', default=1.0,
+        help='Exponent of the power law item popularity follows, 0 rates '
+             'every item alike')
+    parser.add_option('--sample', type='int', default=50,
+        help='Number of objects each per-object benchmark runs on')
+    parser.add_option('--candidates', type='int', default=200,
+        help='Number of items or users compared by top_matches and '
+             'recommendations')
+    parser.add_option('--engine', default='memory',
+        help='Engine calculate_similar_items is timed with')
+    parser.add_option('--repeat', type='int', default=3,
+        help='Number of times each benchmark is run')
+    parser.add_option('--seed', type='int', default=0,
+        help='Seed of the generated ratings')
+    parser.add_option('--database', default='',
+        help='SQLite file to run in, an in-memory database by default')
+    parser.add_option('--output', default=None,
+        help='Path the results are written to as JSON')
+    parser.add_option('--compare', default=None,
+        help='Results of an earlier run to compare against')
+    return parser.parse_args()[0]
+
+
+def power_law_picker(rng, num, skew):
+    """
+    Returns a function picking an index below num, where the index at rank r
+    of a random ordering is picked with a probability proportional to
+    1 / r ** skew
+    """
+    ranking = range(num)
+    rng.shuffle(ranking)
+    cumulative = []
+    total = 0
+    for rank in xrange(num):
+        total += 1.0 / (rank + 1) ** skew
+        cumulative.append(total)
+
+    def pick():
+        return ranking[bisect.bisect(cumulative, rng.random() * total)]
+    return pick
+
+
+def generate(options, rng):
+    """
+    Stores the users, and the same number of foods and snacks with their
+    ratings, returning the foods, snacks and users
+    """
+    User.objects.bulk_create([User(username='user%d' % i)
+                              for i in xrange(options.users)])
+    users = list(User.objects.order_by('pk'))
+
+    rated = []
+    for model in (Food, Snack):
+        model.objects.bulk_create([model(name='%s%d' % (model.__name__, i))
+                                   for i in xrange(options.items)])
+        objects = list(model.objects.order_by('pk'))
+        generate_ratings(options, rng, objects, users)
+        rated.append(objects)
+
+    # snacks keep stored totals, which have to be built once
+    Snack.ratings.rebuild_aggregates()
+    return rated[0], rated[1], users
+
+
+def generate_ratings(options, rng, objects, users):
+    ctype = ContentType.objects.get_for_model(objects[0])
+    pick = power_law_picker(rng, len(objects), options.skew)
+    per_user = min(options.ratings_per_user, len(objects))
+
+    ratings = []
+    for user in users:
+        rated = set()
+        while len(rated) < per_user:
+            rated.add(pick())
+        for index in rated:
+            obj = objects[index]
+            ratings.append(RatedItem(
+                content_type=ctype, object_id=obj.pk, user=user,
+                score=float(rng.randint(1, 5)),
+                hashed=RatedItem.hash_for(obj),
+                item_key=RatedItem.item_key_for(obj)))
+
+    # stay below the SQLite limit on the parameters of a statement
+    for chunk in chunked(ratings, 100):
+        RatedItem.objects.bulk_create(chunk)
+
+
+def run(name, func, args_list, repeat):
+    """
+    Times func called with each of args_list, repeat times, and returns the
+    times and the number of queries of each run
+    """
+    times = []
+    queries = []
+    for i in xrange(repeat):
+        reset_queries()
+        start = time.time()
+        for args in args_list:
+            func(*args)
+        times.append(time.time() - start)
+        queries.append(len(connection.queries))
+
+    times.sort()
+    result = {
+        'calls': len(args_list),
+        'times': times,
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'per_call': times[0] / max(len(args_list), 1),
+        'queries': queries[-1],
+    }
+    print '%-34s %10.4fs %10.6fs/call %8d queries' % (
+        name, result['min'], result['per_call'], result['queries'])
+    return result
+
+
+def benchmarks(options, rng, foods, snacks, users):
+    """
+    Returns (name, function, arguments of each call) for each benchmark.
+    Foods are aggregated with a query per call, snacks read stored totals,
+    which the standard deviation and variance need on SQLite.
+    """
+    ratings = Food.ratings.all()
+    sample_foods = rng.sample(foods, min(options.sample, len(foods)))
+    sample_snacks = rng.sample(snacks, min(options.sample, len(snacks)))
+    sample_users = rng.sample(users, min(options.sample, len(users)))
+    candidate_foods = rng.sample(foods, min(options.candidates, len(foods)))
+    candidate_users = rng.sample(users, min(options.candidates, len(users)))
+
+    def votes(objects):
+        return [(rng.choice(objects), rng.choice(users), rng.randint(1, 5))
+                for i in xrange(options.sample)]
+
+    def rate(obj, user, score):
+        obj.ratings.rate(user, score)
+
+    def aggregate(method):
+        return lambda obj: getattr(obj.ratings, method)()
+
+    food_args = [(food,) for food in sample_foods]
+    snack_args = [(snack,) for snack in sample_snacks]
+    return [
+        ('rate', rate, votes(foods)),
+        ('rate.stored_totals', rate, votes(snacks)),
+        ('cumulative_score', aggregate('cumulative_score'), food_args),
+        ('average_score', aggregate('average_score'), food_args),
+        ('cumulative_score.stored_totals', aggregate('cumulative_score'),
+         snack_args),
+        ('average_score.stored_totals', aggregate('average_score'),
+         snack_args),
+        ('standard_deviation.stored_totals', aggregate('standard_deviation'),
+         snack_args),
+        ('variance.stored_totals', aggregate('variance'), snack_args),
+        ('order_by_rating', lambda: list(Food.ratings.order_by_rating()[:20]),
+         [()]),
+        ('top_matches', lambda food: top_matches(ratings, candidate_foods, food),
+         food_args[:10]),
+        ('recommendations',
+         lambda user: recommendations(ratings, candidate_users, user, n=10),
+         [(user,) for user in sample_users[:10]]),
+        ('calculate_similar_items',
+         lambda: calculate_similar_items(ratings, 10, engine=options.engine),
+         [()]),
+        ('recommended_items',
+         lambda user: recommended_items(ratings, user, n=10),
+         [(user,) for user in sample_users]),
+    ]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=dirname(abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path) as fh:
+        previous = json.load(fh)['results']
+    print
+    print '%-34s %10s %10s %8s' % ('', 'before', 'after', 'ratio')
+    for name in sorted(results):
+        result = results[name]
+        if name not in previous:
+            continue
+        before = previous[name]['min']
+        print '%-34s %10.4f %10.4f %8.2f' % (
+            name, before, result['min'],
+            result['min'] / before if before else 0)
+
+
+def main():
+    options = parse_args()
+    if options.database:
+        settings.DATABASES['default']['TEST_NAME'] = options.database
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    # record the queries without turning on DEBUG
+    connection.use_debug_cursor = True
+
+    rng = random.Random(options.seed)
+    start = time.time()
+    foods, snacks, users = generate(options, rng)
+    print 'Generated %d ratings in %.1fs' % (RatedItem.objects.count(),
+                                             time.time() - start)
+
+    results = {}
+    for name, func, args_list in benchmarks(options, rng, foods, snacks,
+                                            users):
+        results[name] = run(name, func, args_list, options.repeat)
+
+    if options.compare:
+        compare(results, options.compare)
+
+    if options.output:
+        with open(options.output, 'w') as fh:
+            json.dump({
+                'revision': git_revision(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'options': options.__dict__,
+                'results': results,
+            }, fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
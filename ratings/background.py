@@ -0,0 +1,108 @@
+import logging
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+
+
+# number of threads running the a* methods of the ratings managers, 0 runs
+# them in the calling thread instead
+POOL_SIZE = getattr(settings, 'RATINGS_BACKGROUND_THREADS', 4)
+
+logger = logging.getLogger('ratings')
+
+
+class EagerResult(object):
+    """
+    The result of an operation run in the calling thread, with the interface
+    of the AsyncResult returned for operations run by the thread pool
+    """
+    def __init__(self, func, args, kwargs):
+        self.exc_info = None
+        try:
+            self.value = func(*args, **kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self.exc_info is None
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(POOL_SIZE)
+    return _pool
+
+
+def close_connections():
+    # pool threads never finish a request, so their connections are not
+    # closed by the request_finished signal
+    if django.VERSION >= (1, 6):
+        from django.db import close_old_connections
+        close_old_connections()
+    else:
+        for conn in connections.all():
+            conn.close()
+
+
+def _call(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_connections()
+
+
+def run_in_background(func, *args, **kwargs):
+    """
+    Runs func in a thread of the pool, returning an AsyncResult whose get()
+    waits for and returns its result, or raises its exception
+    """
+    if not POOL_SIZE:
+        return EagerResult(func, args, kwargs)
+    return get_pool().apply_async(_call, (func, args, kwargs))
+
+
+def rate_object(ctype_id, object_id, user_id, score):
+    """
+    Stores the vote of a user for an object, a score of None removes it.
+    Votes for objects or users that no longer exist are dropped.  Errors are
+    logged, as nobody waits for the result of a vote.
+    """
+    try:
+        model = ContentType.objects.get_for_id(ctype_id).model_class()
+        try:
+            obj = model._default_manager.get(pk=object_id)
+            user = User.objects.get(pk=user_id)
+        except (model.DoesNotExist, User.DoesNotExist):
+            return
+        manager = getattr(obj, obj._ratings_field)
+        if score is None:
+            manager.unrate(user)
+        else:
+            manager.upsert(user, score)
+    except Exception:
+        logger.exception('Could not store the vote of user %s for %s.%s',
+                         user_id, ctype_id, object_id)
+        raise
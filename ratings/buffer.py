@@ -0,0 +1,211 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.importlib import import_module
+
+from ratings import cache as ratings_cache
+
+
+# the cache votes are buffered in until they are flushed, None buffers them
+# in the memory of each process
+BUFFER_CACHE = getattr(settings, 'RATINGS_VOTE_BUFFER_CACHE', None)
+
+# dotted path of a VoteBuffer subclass to use instead
+BUFFER_CLASS = getattr(settings, 'RATINGS_VOTE_BUFFER', None)
+
+KEY_PREFIX = 'ratings:votes'
+INDEX_KEY = '%s:objects' % KEY_PREFIX
+
+# buffered votes older than this are dropped by the cache
+BUFFER_TIMEOUT = 60 * 60 * 24
+
+LOCK_TIMEOUT = 10
+
+
+class VoteBuffer(object):
+    """
+    Holds votes until they are flushed to the database.  A vote replaces the
+    earlier vote of the same user for the same object, a score of None stands
+    for removing the rating.
+    """
+    # whether every process sees the same votes, so they can be flushed by
+    # the flush_rating_votes command
+    shared = True
+
+    def push(self, ctype_id, object_id, user_id, score):
+        raise NotImplementedError
+
+    def pending(self, ctype_id, object_id):
+        """
+        Returns the buffered votes for an object as {user_id: score}
+        """
+        raise NotImplementedError
+
+    def drain(self):
+        """
+        Removes and returns every buffered vote, as
+        {(ctype_id, object_id): {user_id: score}}
+        """
+        raise NotImplementedError
+
+
+class LocalVoteBuffer(VoteBuffer):
+    """
+    Buffers votes in the memory of the current process.  Only suitable for a
+    single process, and votes not flushed are lost when it exits.
+    """
+    shared = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.votes = {}
+
+    def push(self, ctype_id, object_id, user_id, score):
+        with self.lock:
+            key = (ctype_id, object_id)
+            self.votes.setdefault(key, {})[user_id] = score
+
+    def pending(self, ctype_id, object_id):
+        with self.lock:
+            return dict(self.votes.get((ctype_id, object_id), {}))
+
+    def drain(self):
+        with self.lock:
+            votes, self.votes = self.votes, {}
+        return votes
+
+
+class CacheVoteBuffer(VoteBuffer):
+    """
+    Buffers votes in a Django cache shared by every process.  Votes the cache
+    evicts before they are flushed are lost, so use a cache that does not
+    evict under load.
+    """
+    def __init__(self, alias):
+        self.cache = ratings_cache.get_backend(alias)
+
+    @property
+    def shared(self):
+        # a local memory cache is kept in each process
+        return not isinstance(self.cache, (LocMemCache, DummyCache))
+
+    @contextmanager
+    def lock(self, key):
+        lock_key = '%s:lock' % key
+        while not self.cache.add(lock_key, 1, LOCK_TIMEOUT):
+            time.sleep(0.001)
+        try:
+            yield
+        finally:
+            self.cache.delete(lock_key)
+
+    def object_key(self, ctype_id, object_id):
+        return '%s:%s:%s' % (KEY_PREFIX, ctype_id, object_id)
+
+    def push(self, ctype_id, object_id, user_id, score):
+        key = self.object_key(ctype_id, object_id)
+        with self.lock(key):
+            votes = self.cache.get(key) or {}
+            first = not votes
+            votes[user_id] = score
+            self.cache.set(key, votes, BUFFER_TIMEOUT)
+
+        if first:
+            with self.lock(INDEX_KEY):
+                index = self.cache.get(INDEX_KEY) or set()
+                index.add((ctype_id, object_id))
+                self.cache.set(INDEX_KEY, index, BUFFER_TIMEOUT)
+
+    def pending(self, ctype_id, object_id):
+        return self.cache.get(self.object_key(ctype_id, object_id)) or {}
+
+    def drain(self):
+        with self.lock(INDEX_KEY):
+            index = self.cache.get(INDEX_KEY) or set()
+            self.cache.delete(INDEX_KEY)
+
+        drained = {}
+        for ctype_id, object_id in index:
+            key = self.object_key(ctype_id, object_id)
+            with self.lock(key):
+                votes = self.cache.get(key)
+                self.cache.delete(key)
+            if votes:
+                drained[ctype_id, object_id] = votes
+        return drained
+
+
+_buffer = None
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        if BUFFER_CLASS:
+            module, name = BUFFER_CLASS.rsplit('.', 1)
+            _buffer = getattr(import_module(module), name)()
+        elif BUFFER_CACHE:
+            _buffer = CacheVoteBuffer(BUFFER_CACHE)
+        else:
+            _buffer = LocalVoteBuffer()
+    return _buffer
+
+
+def buffer_vote(ctype_id, object_id, user_id, score):
+    """
+    Queue a vote to be written by the next flush_votes(), a score of None
+    removes the rating
+    """
+    get_buffer().push(ctype_id, object_id, user_id, score)
+
+
+def pending_votes(instance):
+    ctype = ContentType.objects.get_for_model(instance)
+    return get_buffer().pending(ctype.pk, instance.pk)
+
+
+def flush_votes(batch_size=500):
+    """
+    Write the buffered votes to the database, with the votes for each model
+    stored in bulk.  Votes for objects or users that no longer exist are
+    dropped.  Returns the number of votes written.
+    """
+    by_ctype = {}
+    for (ctype_id, object_id), votes in get_buffer().drain().iteritems():
+        by_ctype.setdefault(ctype_id, {})[object_id] = votes
+
+    written = 0
+    for ctype_id, objects in by_ctype.iteritems():
+        model = ContentType.objects.get_for_id(ctype_id).model_class()
+        if model is None or not hasattr(model, '_ratings_field'):
+            continue
+        instances = model._default_manager.in_bulk(objects.keys())
+        user_ids = set()
+        for votes in objects.itervalues():
+            user_ids.update(votes)
+        users = User.objects.in_bulk(list(user_ids))
+
+        ratings = []
+        for object_id, votes in objects.iteritems():
+            instance = instances.get(object_id)
+            if instance is None:
+                continue
+            for user_id, score in votes.iteritems():
+                if user_id not in users:
+                    continue
+                if score is None:
+                    getattr(instance, model._ratings_field).unrate(
+                        users[user_id])
+                else:
+                    ratings.append((instance, users[user_id], score))
+                written += 1
+
+        getattr(model, model._ratings_field).rate_many(ratings,
+                                                       batch_size=batch_size)
+    return written
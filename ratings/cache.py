@@ -0,0 +1,118 @@
+import time
+
+import django
+from django.conf import settings
+from django.db.models.query import QuerySet
+
+
+# the cache recommendations and similar items are stored in, None disables
+# caching of results
+CACHE_ALIAS = getattr(settings, 'RATINGS_CACHE', None)
+CACHE_TIMEOUT = getattr(settings, 'RATINGS_CACHE_TIMEOUT', 3600)
+
+# results with more entries than this are not cached
+CACHE_MAX_RESULTS = getattr(settings, 'RATINGS_CACHE_MAX_RESULTS', 100)
+
+KEY_PREFIX = 'ratings'
+
+# version of every cached result, bumped when similar items are recalculated
+GENERATION_KEY = '%s:generation' % KEY_PREFIX
+
+
+def get_backend(alias=None):
+    alias = alias or CACHE_ALIAS
+    if alias is None:
+        return None
+    if django.VERSION < (1, 7):
+        from django.core.cache import get_cache
+        return get_cache(alias)
+    from django.core.cache import caches
+    return caches[alias]
+
+
+def user_key(user):
+    # version of the results cached for a single user
+    return '%s:user:%s' % (KEY_PREFIX, user.pk)
+
+
+def item_key(obj):
+    # version of the results cached for a single rated object
+    return '%s:item:%s:%s' % (KEY_PREFIX, obj._meta, obj.pk)
+
+
+def get_versions(backend, keys):
+    versions = backend.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # start from the clock rather than 0, so a version that was
+            # evicted can not bring back results cached under its old value
+            backend.add(key, int(time.time() * 1000), None)
+            versions[key] = backend.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump_version(key):
+    backend = get_backend()
+    if backend is None:
+        return
+    try:
+        backend.incr(key)
+    except ValueError:
+        backend.set(key, int(time.time() * 1000), None)
+
+
+def invalidate_user(user):
+    """
+    Drop the results cached for user, for instance after they rated something
+    """
+    bump_version(user_key(user))
+
+
+def invalidate_item(obj):
+    """
+    Drop the results cached for obj, for instance after it was rated
+    """
+    bump_version(item_key(obj))
+
+
+def invalidate_all():
+    """
+    Drop every cached result, for instance after similar items were
+    recalculated
+    """
+    bump_version(GENERATION_KEY)
+
+
+def cached(key, dependencies, compute):
+    """
+    Returns the result cached under key for the current versions of the
+    dependencies, a list of version keys.  On a miss the result of compute()
+    is evaluated and its rows cached.  A queryset is returned as a queryset
+    either way, holding the cached rows on a hit, so callers get the same
+    type whether or not a cache is configured.
+    """
+    backend = get_backend()
+    if backend is None:
+        return compute()
+
+    versions = get_versions(backend, [GENERATION_KEY] + dependencies)
+    versioned_key = '%s:%s:%s' % (KEY_PREFIX, key,
+                                  ':'.join(str(v) for v in versions))
+
+    cached_value = backend.get(versioned_key)
+    if cached_value is None:
+        result = compute()
+        rows = list(result)
+        is_queryset = isinstance(result, QuerySet)
+        if len(rows) <= CACHE_MAX_RESULTS:
+            backend.set(versioned_key, (is_queryset, rows), CACHE_TIMEOUT)
+        return result if is_queryset else rows
+
+    is_queryset, rows = cached_value
+    if not is_queryset:
+        return rows
+    # building a queryset runs no query, and its result cache is filled from
+    # the cached rows rather than by evaluating it
+    result = compute()
+    result._result_cache = rows
+    return result
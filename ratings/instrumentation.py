@@ -0,0 +1,255 @@
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections, models
+from django.dispatch import Signal
+
+from ratings import cache as ratings_cache
+
+
+# whether the ratings operations are timed, when False the instrumented
+# functions only pay for checking this flag
+ENABLED = getattr(settings, 'RATINGS_INSTRUMENTATION', False)
+
+# the cache the timings are collected in, so the ratings_stats command sees
+# the operations of every process, None keeps them in the memory of each
+# process
+STATS_CACHE = getattr(settings, 'RATINGS_INSTRUMENTATION_CACHE', None)
+
+KEY_PREFIX = 'ratings:stats'
+INDEX_KEY = '%s:operations' % KEY_PREFIX
+
+STATS_TIMEOUT = 60 * 60 * 24 * 7
+
+LOCK_TIMEOUT = 10
+
+# sent after every instrumented operation, with the rated or rating model as
+# the sender when there is one
+operation_finished = Signal(providing_args=['operation', 'duration',
+                                            'queries', 'rows'])
+
+_state = threading.local()
+
+
+def _model_of(args):
+    if not args:
+        return None
+    obj = args[0]
+    if isinstance(obj, models.Model):
+        return type(obj)
+    # the ratings manager of an object reports the model of that object
+    instance = getattr(obj, 'instance', None)
+    if isinstance(instance, models.Model):
+        return type(instance)
+    model = getattr(obj, 'rated_model', None) or getattr(obj, 'model', None)
+    if isinstance(model, type) and issubclass(model, models.Model):
+        return model
+    return None
+
+
+def count_rows(result):
+    """
+    Returns the number of rows in the result of an operation: the length of
+    a list, a dictionary or a set, one for a model instance and None when it
+    cannot be told without evaluating it
+    """
+    if isinstance(result, (list, dict, set, frozenset)):
+        return len(result)
+    if isinstance(result, models.Model):
+        return 1
+    return None
+
+
+def instrumented(operation=None, rows=count_rows):
+    """
+    Decorator timing a ratings operation and counting its queries while
+    instrumentation is enabled.  rows is a function returning the number of
+    rows from the result of the operation.  Operations returning querysets
+    are timed until the queryset is built, not until it is evaluated.
+    """
+    def decorator(func):
+        name = operation or func.__name__
+
+        @wraps(func)
+        def inner(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+
+            outermost = not getattr(_state, 'depth', 0)
+            _state.depth = getattr(_state, 'depth', 0) + 1
+            if outermost:
+                # queries are only recorded by a debug cursor
+                _state.connections = []
+                for conn in connections.all():
+                    _state.connections.append(
+                        (conn, conn.use_debug_cursor, len(conn.queries)))
+                    conn.use_debug_cursor = True
+
+            queries = sum(len(conn.queries) for conn in connections.all())
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                duration = time.time() - start
+                queries = sum(len(conn.queries)
+                              for conn in connections.all()) - queries
+                _state.depth -= 1
+                if outermost:
+                    for conn, use_debug_cursor, num in _state.connections:
+                        recording = (use_debug_cursor or
+                                     use_debug_cursor is None and
+                                     settings.DEBUG)
+                        conn.use_debug_cursor = use_debug_cursor
+                        if not recording:
+                            del conn.queries[num:]
+                    del _state.connections
+
+            operation_finished.send(sender=_model_of(args), operation=name,
+                                    duration=duration, queries=queries,
+                                    rows=rows(result))
+            return result
+        return inner
+    return decorator
+
+
+class OperationStats(object):
+    """
+    Totals of the instrumented operations, per operation and model
+    """
+    def record(self, operation, model, duration, queries, rows):
+        raise NotImplementedError
+
+    def totals(self):
+        """
+        Returns {(operation, model label): {'calls': ..., 'duration': ...,
+        'max_duration': ..., 'queries': ..., 'rows': ...}}
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+
+class LocalOperationStats(OperationStats):
+    """
+    Collects the totals in the memory of the current process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, operation, model, duration, queries, rows):
+        with self.lock:
+            stats = self.stats.setdefault((operation, model), {
+                'calls': 0, 'duration': 0.0, 'max_duration': 0.0,
+                'queries': 0, 'rows': 0})
+            stats['calls'] += 1
+            stats['duration'] += duration
+            stats['max_duration'] = max(stats['max_duration'], duration)
+            stats['queries'] += queries
+            stats['rows'] += rows or 0
+
+    def totals(self):
+        with self.lock:
+            return dict((key, dict(stats))
+                        for key, stats in self.stats.iteritems())
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+
+class CacheOperationStats(OperationStats):
+    """
+    Collects the totals in a Django cache shared by every process.  Durations
+    are counted in microseconds, as caches only increment integers.
+    """
+    counters = ('calls', 'duration', 'queries', 'rows')
+
+    def __init__(self, alias):
+        self.cache = ratings_cache.get_backend(alias)
+
+    def stats_key(self, operation, model, counter):
+        return '%s:%s:%s:%s' % (KEY_PREFIX, operation, model, counter)
+
+    def record(self, operation, model, duration, queries, rows):
+        values = {
+            'calls': 1,
+            'duration': int(duration * 1e6),
+            'queries': queries,
+            'rows': rows or 0,
+        }
+        for counter, value in values.iteritems():
+            key = self.stats_key(operation, model, counter)
+            if not self.cache.add(key, value, STATS_TIMEOUT):
+                try:
+                    self.cache.incr(key, value)
+                except ValueError:
+                    # expired between the add and the incr
+                    self.cache.set(key, value, STATS_TIMEOUT)
+
+        max_key = self.stats_key(operation, model, 'max_duration')
+        if values['duration'] > (self.cache.get(max_key) or 0):
+            self.cache.set(max_key, values['duration'], STATS_TIMEOUT)
+
+        index = self.cache.get(INDEX_KEY) or set()
+        if (operation, model) not in index:
+            lock_key = '%s:lock' % INDEX_KEY
+            while not self.cache.add(lock_key, 1, LOCK_TIMEOUT):
+                time.sleep(0.001)
+            try:
+                index = self.cache.get(INDEX_KEY) or set()
+                index.add((operation, model))
+                self.cache.set(INDEX_KEY, index, STATS_TIMEOUT)
+            finally:
+                self.cache.delete(lock_key)
+
+    def totals(self):
+        index = self.cache.get(INDEX_KEY) or set()
+        totals = {}
+        for operation, model in index:
+            keys = dict((self.stats_key(operation, model, counter), counter)
+                        for counter in self.counters + ('max_duration',))
+            values = self.cache.get_many(keys.keys())
+            stats = dict((counter, values.get(key, 0))
+                         for key, counter in keys.iteritems())
+            stats['duration'] /= 1e6
+            stats['max_duration'] /= 1e6
+            totals[operation, model] = stats
+        return totals
+
+    def reset(self):
+        index = self.cache.get(INDEX_KEY) or set()
+        self.cache.delete_many([
+            self.stats_key(operation, model, counter)
+            for operation, model in index
+            for counter in self.counters + ('max_duration',)])
+        self.cache.delete(INDEX_KEY)
+
+
+_stats = None
+
+
+def get_stats():
+    global _stats
+    if _stats is None:
+        if STATS_CACHE:
+            _stats = CacheOperationStats(STATS_CACHE)
+        else:
+            _stats = LocalOperationStats()
+    return _stats
+
+
+def _model_label(model):
+    if model is None:
+        return ''
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def collect_stats(sender, operation, duration, queries, rows, **kwargs):
+    get_stats().record(operation, _model_label(sender), duration, queries,
+                       rows)
+
+operation_finished.connect(collect_stats)
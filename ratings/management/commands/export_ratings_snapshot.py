@@ -0,0 +1,59 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+from ratings.models import _RatingsDescriptor
+
+
+class Command(BaseCommand):
+    help = "Write the ratings of a model to a snapshot file."
+    args = '<app_label.ModelName> <path>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--field', action='store', dest='field', default=None,
+            help='Name of the ratings field, when the model has several'
+        ),
+    )
+
+    # Django 1.0.X compatibility.
+    verbosity_present = False
+
+    for option in option_list:
+        if option.get_opt_string() == '--verbosity':
+            verbosity_present = True
+
+    if verbosity_present is False:
+        option_list = option_list + (
+            make_option('--verbosity', action='store', dest='verbosity',
+                default='1', type='choice', choices=['0', '1', '2'],
+                help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        from django.db.models import get_model
+
+        if len(args) != 2:
+            raise CommandError('Enter a model and the path of the snapshot.')
+        label, path = args
+        verbosity = int(options.get('verbosity', 1))
+        field = options.get('field')
+
+        try:
+            app_label, model_name = label.split('.')
+        except ValueError:
+            raise CommandError('Enter the model as app_label.ModelName.')
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model: %s' % label)
+
+        fields = [k for k, v in model.__dict__.iteritems()
+                  if isinstance(v, _RatingsDescriptor)]
+        if field is None and len(fields) == 1:
+            field = fields[0]
+        if field not in fields:
+            raise CommandError('Choose the ratings field of %s with --field, '
+                               'one of: %s' % (label, ', '.join(fields)))
+
+        if verbosity > 0:
+            print 'Exporting the %s field of %s to %s' % (field, model, path)
+        getattr(model, field).export_snapshot(path)
@@ -0,0 +1,56 @@
+import time
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+
+from ratings.buffer import flush_votes, get_buffer
+
+
+class Command(BaseCommand):
+    help = "Write the votes queued in the vote buffer to the database."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--interval', action='store', dest='interval',
+            default=None, type='float',
+            help='Keep running, flushing the buffer every this many seconds'
+        ),
+        make_option('--batch-size', action='store', dest='batch_size',
+            default=500, type='int',
+            help='Number of ratings written per batch'
+        ),
+    )
+
+    # Django 1.0.X compatibility.
+    verbosity_present = False
+
+    for option in option_list:
+        if option.get_opt_string() == '--verbosity':
+            verbosity_present = True
+
+    if verbosity_present is False:
+        option_list = option_list + (
+            make_option('--verbosity', action='store', dest='verbosity',
+                default='1', type='choice', choices=['0', '1', '2'],
+                help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        interval = options.get('interval')
+        batch_size = int(options.get('batch_size') or 500)
+
+        if not get_buffer().shared:
+            raise CommandError(
+                'The votes are buffered in the memory of the processes '
+                'receiving them, where this command cannot reach them.  Set '
+                'RATINGS_VOTE_BUFFER_CACHE to a cache shared by every '
+                'process.')
+
+        while True:
+            written = flush_votes(batch_size)
+            if verbosity > 0:
+                print 'Wrote %d buffered votes' % written
+            if not interval:
+                break
+            time.sleep(interval)
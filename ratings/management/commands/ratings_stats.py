@@ -0,0 +1,56 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+
+from ratings.instrumentation import get_stats
+
+
+SORT_KEYS = ('duration', 'calls', 'queries', 'rows', 'max_duration')
+
+
+class Command(BaseCommand):
+    help = "Show the time and queries spent in the ratings operations."
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sort', action='store', dest='sort',
+            default='duration', type='choice', choices=list(SORT_KEYS),
+            help='Total the operations are sorted by'
+        ),
+        make_option('--reset', action='store_true', dest='reset',
+            default=False,
+            help='Clear the totals after showing them'
+        ),
+    )
+
+    # Django 1.0.X compatibility.
+    verbosity_present = False
+
+    for option in option_list:
+        if option.get_opt_string() == '--verbosity':
+            verbosity_present = True
+
+    if verbosity_present is False:
+        option_list = option_list + (
+            make_option('--verbosity', action='store', dest='verbosity',
+                default='1', type='choice', choices=['0', '1', '2'],
+                help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'
+            ),
+        )
+
+    def handle(self, *args, **options):
+        sort = options.get('sort') or 'duration'
+        stats = get_stats()
+        totals = stats.totals()
+
+        print '%-25s %-25s %8s %10s %10s %10s %8s %8s' % (
+            'operation', 'model', 'calls', 'total (s)', 'mean (ms)',
+            'max (ms)', 'queries', 'rows')
+        rows = sorted(totals.iteritems(), key=lambda row: row[1][sort],
+                      reverse=True)
+        for (operation, model), row in rows:
+            print '%-25s %-25s %8d %10.3f %10.2f %10.2f %8d %8d' % (
+                operation, model, row['calls'], row['duration'],
+                1000 * row['duration'] / max(row['calls'], 1),
+                1000 * row['max_duration'], row['queries'], row['rows'])
+
+        if options.get('reset'):
+            stats.reset()
@@ -0,0 +1,68 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import AppCommand
+
+from ratings.models import _RatingsDescriptor, LEADERBOARD_AGGREGATORS
+
+
+class Command(AppCommand):
+    help = "Rebuild the leaderboards of top rated objects for any or all apps."
+
+    option_list = AppCommand.option_list + (
+        make_option('--aggregator', action='append', dest='aggregators',
+            type='choice', choices=sorted(LEADERBOARD_AGGREGATORS),
+            help='Aggregator to rank objects by, may be given several times; '
+                 'defaults to sum'
+        ),
+        make_option('--size', action='store', dest='size',
+            default=None, type='int',
+            help='Number of objects kept on each leaderboard'
+        ),
+    )
+
+    # Django 1.0.X compatibility.
+    verbosity_present = False
+
+    for option in option_list:
+        if option.get_opt_string() == '--verbosity':
+            verbosity_present = True
+
+    if verbosity_present is False:
+        option_list = option_list + (
+            make_option('--verbosity', action='store', dest='verbosity',
+                default='1', type='choice', choices=['0', '1', '2'],
+                help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'
+            ),
+        )
+
+    def handle(self, *apps, **options):
+        self.verbosity = int(options.get('verbosity', 1))
+        self.aggregators = options.get('aggregators') or ['sum']
+        self.size = options.get('size')
+
+        if not apps:
+            from django.db.models import get_app
+            apps = []
+
+            for app in settings.INSTALLED_APPS:
+                try:
+                    app_label = app.split('.')[-1]
+                    get_app(app_label)
+                    apps.append(app_label)
+                except:
+                    pass
+
+        return super(Command, self).handle(*apps, **options)
+
+    def handle_app(self, app, **options):
+        from django.db.models import get_models
+
+        for model in get_models(app):
+            for k, v in model.__dict__.iteritems():
+                if isinstance(v, _RatingsDescriptor):
+                    for name in self.aggregators:
+                        if self.verbosity > 0:
+                            print 'Ranking %s by the %s of its %s' % (
+                                model, name, k)
+                        getattr(model, k).update_leaderboard(
+                            LEADERBOARD_AGGREGATORS[name], self.size)
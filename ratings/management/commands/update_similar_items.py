@@ -3,14 +3,49 @@ from django.conf import settings
 from django.core.management.base import AppCommand
 
 from ratings.models import _RatingsDescriptor
+from ratings.snapshot import RatingsSnapshot
+from ratings.utils import SIMILARITY_ENGINES, lsh_recall
 
 
 class Command(AppCommand):
     help = "Update the similar items table for any or all apps."
 
+    option_list = AppCommand.option_list + (
+        make_option('--engine', action='store', dest='engine',
+            default='sql', type='choice', choices=list(SIMILARITY_ENGINES),
+            help='How similarities are computed; sql=one query per pair of '
+                 'items, memory=load all ratings once and compute in memory, '
+                 'lsh=like memory but only for pairs likely to be similar'
+        ),
+        make_option('--incremental', action='store_true', dest='incremental',
+            default=False,
+            help='Only recompute the items whose ratings changed since the '
+                 'last run, and the items related to them'
+        ),
+        make_option('--workers', action='store', dest='workers',
+            default=1, type='int',
+            help='Number of processes calculating similar items in parallel'
+        ),
+        make_option('--bands', action='store', dest='bands',
+            default=None, type='int',
+            help='Number of hash bands used by the lsh engine; more bands '
+                 'find more similar items but take longer'
+        ),
+        make_option('--recall', action='store_true', dest='recall',
+            default=False,
+            help='Report the share of the exact similar items the lsh engine '
+                 'finds, measured on a sample of items'
+        ),
+        make_option('--snapshot', action='store', dest='snapshot',
+            default=None,
+            help='Read the ratings from a snapshot file written by '
+                 'export_ratings_snapshot instead of the database; requires '
+                 'the memory or lsh engine'
+        ),
+    )
+
     # Django 1.0.X compatibility.
     verbosity_present = False
-    option_list = AppCommand.option_list
 
     for option in option_list:
         if option.get_opt_string() == '--verbosity':
@@ -26,6 +61,14 @@ class Command(AppCommand):
 
     def handle(self, *apps, **options):
         self.verbosity = int(options.get('verbosity', 1))
+        self.engine = options.get('engine') or 'sql'
+        self.incremental = options.get('incremental', False)
+        self.workers = int(options.get('workers') or 1)
+        self.bands = options.get('bands')
+        self.recall = options.get('recall', False)
+        self.snapshot = None
+        if options.get('snapshot'):
+            self.snapshot = RatingsSnapshot(options['snapshot'])
 
         if not apps:
             from django.db.models import get_app
@@ -49,4 +92,16 @@ class Command(AppCommand):
                 if isinstance(v, _RatingsDescriptor):
                     if self.verbosity > 0:
                         print 'Updating the %s field of %s' % (k, model)
-                    getattr(model, k).update_similar_items()
+                    descriptor = getattr(model, k)
+                    snapshot = self.snapshot
+                    if snapshot and (snapshot.rated_model is not model or
+                            snapshot.rating_model is not v.rating_model):
+                        snapshot = None
+                    if self.recall and self.engine == 'lsh':
+                        recall = lsh_recall(descriptor.all(),
+                                            bands=self.bands)
+                        print 'Recall of the lsh engine: %.3f' % recall
+                    descriptor.update_similar_items(
+                        engine=self.engine, incremental=self.incremental,
+                        workers=self.workers, bands=self.bands,
+                        snapshot=snapshot)
@@ -0,0 +1,141 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'Leaderboard'
+        db.create_table('ratings_leaderboard', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('content_type', self.gf('django.db.models.fields.related.ForeignKey')(related_name='leaderboards', to=orm['contenttypes.ContentType'])),
+            ('board', self.gf('django.db.models.fields.CharField')(max_length=20)),
+            ('size', self.gf('django.db.models.fields.IntegerField')()),
+            ('threshold', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+        ))
+        db.send_create_signal('ratings', ['Leaderboard'])
+
+        # Adding unique constraint on 'Leaderboard', fields ['content_type', 'board']
+        db.create_unique('ratings_leaderboard', ['content_type_id', 'board'])
+
+        # Adding model 'LeaderboardEntry'
+        db.create_table('ratings_leaderboardentry', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('leaderboard', self.gf('django.db.models.fields.related.ForeignKey')(related_name='entries', to=orm['ratings.Leaderboard'])),
+            ('object_id', self.gf('django.db.models.fields.IntegerField')()),
+            ('score', self.gf('django.db.models.fields.FloatField')(db_index=True)),
+        ))
+        db.send_create_signal('ratings', ['LeaderboardEntry'])
+
+        # Adding unique constraint on 'LeaderboardEntry', fields ['leaderboard', 'object_id']
+        db.create_unique('ratings_leaderboardentry', ['leaderboard_id', 'object_id'])
+
+
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'LeaderboardEntry', fields ['leaderboard', 'object_id']
+        db.delete_unique('ratings_leaderboardentry', ['leaderboard_id', 'object_id'])
+
+        # Removing unique constraint on 'Leaderboard', fields ['content_type', 'board']
+        db.delete_unique('ratings_leaderboard', ['content_type_id', 'board'])
+
+        # Deleting model 'LeaderboardEntry'
+        db.delete_table('ratings_leaderboardentry')
+
+        # Deleting model 'Leaderboard'
+        db.delete_table('ratings_leaderboard')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'blank': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'ratings.dirtyitem': {
+            'Meta': {'object_name': 'DirtyItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'dirty_items'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {})
+        },
+        'ratings.leaderboard': {
+            'Meta': {'unique_together': "(('content_type', 'board'),)", 'object_name': 'Leaderboard'},
+            'board': ('django.db.models.fields.CharField', [], {'max_length': '20'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'leaderboards'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'size': ('django.db.models.fields.IntegerField', [], {}),
+            'threshold': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'ratings.leaderboardentry': {
+            'Meta': {'unique_together': "(('leaderboard', 'object_id'),)", 'object_name': 'LeaderboardEntry'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'leaderboard': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'entries'", 'to': "orm['ratings.Leaderboard']"}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {}),
+            'score': ('django.db.models.fields.FloatField', [], {'db_index': 'True'})
+        },
+        'ratings.rateditem': {
+            'Meta': {'unique_together': "(('user', 'hashed'),)", 'object_name': 'RatedItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'rated_items'", 'to': "orm['contenttypes.ContentType']"}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'hashed': ('django.db.models.fields.CharField', [], {'max_length': '40', 'db_index': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {}),
+            'score': ('django.db.models.fields.FloatField', [], {'default': '0', 'db_index': 'True'}),
+            'updated': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'rateditems'", 'to': "orm['auth.User']"})
+        },
+        'ratings.ratingaggregate': {
+            'Meta': {'unique_together': "(('content_type', 'object_id'),)", 'object_name': 'RatingAggregate'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'rating_aggregates'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'num_ratings': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {}),
+            'total_score': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'total_squares': ('django.db.models.fields.FloatField', [], {'default': '0'})
+        },
+        'ratings.similaritem': {
+            'Meta': {'object_name': 'SimilarItem'},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'similar_items'", 'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'object_id': ('django.db.models.fields.IntegerField', [], {}),
+            'score': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'similar_content_type': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'similar_items_set'", 'to': "orm['contenttypes.ContentType']"}),
+            'similar_object_id': ('django.db.models.fields.IntegerField', [], {})
+        }
+    }
+
+    complete_apps = ['ratings']
@@ -1,24 +1,87 @@
 import hashlib
+import itertools
+from collections import OrderedDict
+from math import sqrt
+
 import django
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import GenericForeignKey
-from django.db import models
+from django.db import models, IntegrityError
+from django.db.backends.signals import connection_created
 from django.db.models.query import QuerySet
+from django.utils import timezone
 
-from ratings.utils import get_content_object_field, is_gfk, recommended_items
+from ratings import cache as ratings_cache
+from ratings.background import run_in_background
+from ratings.buffer import pending_votes
+from ratings.instrumentation import instrumented
+from ratings.utils import atomic, chunked, get_content_object_field, \
+    has_save_receivers, is_gfk, recommended_items, upsert_row, \
+    score_subquery_sql, Ranker
 
 from generic_aggregation import generic_annotate
 
 
+# record the objects whose ratings change in the DirtyItem table, so that
+# update_similar_items --incremental only has to recompute their neighbours
+TRACK_DIRTY_ITEMS = getattr(settings, 'RATINGS_TRACK_DIRTY_ITEMS', False)
+
+# most parameters bound in one statement, below the 999 SQLite allows
+MAX_QUERY_PARAMS = 900
+
+# number of objects kept on a leaderboard
+LEADERBOARD_SIZE = getattr(settings, 'RATINGS_LEADERBOARD_SIZE', 100)
+
+# move objects on their leaderboards whenever their stored totals change,
+# rather than only when the leaderboards are rebuilt
+UPDATE_LEADERBOARDS = getattr(settings, 'RATINGS_UPDATE_LEADERBOARDS', False)
+
+# aggregators a leaderboard can rank by, by board name
+LEADERBOARD_AGGREGATORS = {
+    'sum': models.Sum,
+    'avg': models.Avg,
+    'count': models.Count,
+    'max': models.Max,
+    'min': models.Min,
+}
+
+
+def _sqlite_power(x, y):
+    if x is None or y is None:
+        return None
+    return x ** y
+
+
+def _sqlite_sqrt(x):
+    if x is None:
+        return None
+    return sqrt(x)
+
+
+def register_sqlite_functions(sender, connection, **kwargs):
+    # SQLite has no POWER() or SQRT(), used by order_by_rating to decay old
+    # ratings and rank by WilsonScore
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function('POWER', 2, _sqlite_power)
+        connection.connection.create_function('SQRT', 1, _sqlite_sqrt)
+
+connection_created.connect(register_sqlite_functions)
+
+
 class RatedItemBase(models.Model):
     score = models.FloatField(default=0, db_index=True)
     user = models.ForeignKey(User, related_name='%(class)ss')
     hashed = models.CharField(max_length=40, editable=False, db_index=True)
+    item_key = models.BigIntegerField(null=True, editable=False, db_index=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    updated = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         abstract = True
+        unique_together = (('user', 'hashed'),)
 
     def __unicode__(self):
         return u"%s rated %s by %s" % (self.content_object, self.score,
@@ -26,14 +89,46 @@ class RatedItemBase(models.Model):
 
     def save(self, *args, **kwargs):
         self.hashed = self.generate_hash()
+        self.item_key = self.generate_item_key()
         super(RatedItemBase, self).save(*args, **kwargs)
+        self.mark_dirty()
+
+    def delete(self, *args, **kwargs):
+        self.mark_dirty()
+        super(RatedItemBase, self).delete(*args, **kwargs)
+
+    def mark_dirty(self):
+        if TRACK_DIRTY_ITEMS:
+            content_field = get_content_object_field(self)
+            DirtyItem.mark(getattr(self, content_field.name))
 
     def generate_hash(self):
         content_field = get_content_object_field(self)
-        related_object = getattr(self, content_field.name)
-        uniq = '%s.%s' % (related_object._meta, related_object.pk)
+        return self.hash_for(getattr(self, content_field.name))
+
+    @classmethod
+    def hash_for(cls, instance):
+        uniq = '%s.%s' % (instance._meta, instance.pk)
         return hashlib.sha1(uniq).hexdigest()
 
+    def generate_item_key(self):
+        content_field = get_content_object_field(self)
+        return self.item_key_for(getattr(self, content_field.name))
+
+    @classmethod
+    def item_key_for(cls, instance):
+        """
+        Returns a 64-bit integer identifying instance, the content type id in
+        the high and the primary key in the low 32 bits.  Primary keys that
+        do not fit get a negative key derived from their hash, which cannot
+        collide with the keys of integer primary keys.
+        """
+        pk = instance.pk
+        if isinstance(pk, (int, long)) and -2 ** 31 <= pk < 2 ** 31:
+            ctype = ContentType.objects.get_for_model(instance)
+            return (ctype.pk << 32) + pk
+        return -(int(cls.hash_for(instance)[:15], 16) + 2 ** 31)
+
     @classmethod
     def lookup_kwargs(cls, instance):
         return {'content_object': instance}
@@ -60,14 +155,123 @@ class RatedItem(RatedItemBase):
         return {'content_type': ContentType.objects.get_for_model(model_class)}
 
 
+class RatingAggregateBase(models.Model):
+    """
+    Running totals of the ratings of a single object, from which the
+    statistics offered by the ratings manager can be read without
+    aggregating over the ratings table
+    """
+    num_ratings = models.IntegerField(default=0)
+    total_score = models.FloatField(default=0)
+    total_squares = models.FloatField(default=0)
+
+    class Meta:
+        abstract = True
+
+    def __unicode__(self):
+        return u"%s: %s ratings totalling %s" % (self.content_object,
+                                                 self.num_ratings,
+                                                 self.total_score)
+
+    @classmethod
+    def lookup_kwargs(cls, instance):
+        return {'content_object': instance}
+
+    @classmethod
+    def base_kwargs(cls, model_class):
+        return {}
+
+    @classmethod
+    def adjust(cls, instance, num_ratings=0, total_score=0, total_squares=0):
+        """
+        Atomically add the given deltas to the totals stored for instance
+        """
+        lookup_kwargs = cls.lookup_kwargs(instance)
+        queryset = cls._default_manager.filter(**lookup_kwargs)
+        updated = queryset.update(
+            num_ratings=models.F('num_ratings') + num_ratings,
+            total_score=models.F('total_score') + total_score,
+            total_squares=models.F('total_squares') + total_squares)
+        if not updated:
+            try:
+                with atomic():
+                    cls._default_manager.create(num_ratings=num_ratings,
+                                                total_score=total_score,
+                                                total_squares=total_squares,
+                                                **lookup_kwargs)
+            except IntegrityError:
+                # lost the race to create the row, so it can be updated now
+                return cls.adjust(instance, num_ratings, total_score,
+                                  total_squares)
+        if UPDATE_LEADERBOARDS:
+            Leaderboard.update_object(instance, cls.get_for(instance))
+
+    @classmethod
+    def get_for(cls, instance):
+        """
+        Returns the totals for instance, which are all zero for an object
+        without ratings
+        """
+        lookup_kwargs = cls.lookup_kwargs(instance)
+        try:
+            return cls._default_manager.get(**lookup_kwargs)
+        except cls.DoesNotExist:
+            return cls(**lookup_kwargs)
+
+    def cumulative_score(self):
+        if not self.num_ratings:
+            return None
+        return self.total_score
+
+    def average_score(self):
+        if not self.num_ratings:
+            return None
+        return self.total_score / self.num_ratings
+
+    def variance(self):
+        # the population variance, as calculated by models.Variance
+        if not self.num_ratings:
+            return None
+        average = self.total_score / self.num_ratings
+        return max(self.total_squares / self.num_ratings - average ** 2, 0)
+
+    def standard_deviation(self):
+        if not self.num_ratings:
+            return None
+        return sqrt(self.variance())
+
+
+class RatingAggregate(RatingAggregateBase):
+    object_id = models.IntegerField()
+    content_type = models.ForeignKey(ContentType,
+                                     related_name="rating_aggregates")
+    content_object = GenericForeignKey()
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+
+    @classmethod
+    def lookup_kwargs(cls, instance):
+        return {
+            'object_id': instance.pk,
+            'content_type': ContentType.objects.get_for_model(instance)
+        }
+
+    @classmethod
+    def base_kwargs(cls, model_class):
+        return {'content_type': ContentType.objects.get_for_model(model_class)}
+
+
 # this goes on your model
 class Ratings(object):
-    def __init__(self, rating_model=None):
+    def __init__(self, rating_model=None, aggregate_model=None):
         self.rating_model = rating_model or RatedItem
+        self.aggregate_model = aggregate_model
 
     def contribute_to_class(self, cls, name):
         # set up the ForeignRelatedObjectsDescriptor right hyah
-        setattr(cls, name, _RatingsDescriptor(cls, self.rating_model, name))
+        setattr(cls, name, _RatingsDescriptor(cls, self.rating_model, name,
+                                              self.aggregate_model))
         setattr(cls, '_ratings_field', name)
 
 
@@ -85,8 +289,10 @@ class RatingsQuerySet(QuerySet):
         instance.rated_model = self.rated_model
         return instance
 
+    @instrumented()
     def order_by_rating(self, aggregator=models.Sum, descending=True,
-                        queryset=None, alias='score'):
+                        queryset=None, alias='score', half_life=None,
+                        window=None):
         related_field = get_content_object_field(self.model)
 
         if queryset is None:
@@ -94,6 +300,28 @@ class RatingsQuerySet(QuerySet):
 
         ordering = descending and '-%s' % alias or alias
 
+        if (half_life is not None or window is not None or
+                isinstance(aggregator, Ranker)):
+            # ratings weighted by their age, only recent ones, or rankings
+            # which are not plain aggregates
+            if len(self.query.where.children):
+                # like the annotations below, only objects with ratings in
+                # a filtered ratings queryset are ranked
+                key = (is_gfk(related_field) and related_field.fk_field or
+                       related_field.name)
+                queryset = queryset.filter(pk__in=self.values_list(key))
+
+            sql, params = score_subquery_sql(self, queryset.model,
+                                             aggregator, half_life, window)
+            # objects without ratings score NULL, which databases disagree
+            # on where to sort, so they are put last explicitly
+            null_alias = '%s_is_null' % alias
+            select = OrderedDict([(alias, sql),
+                                  (null_alias, '(%s) IS NULL' % sql)])
+            return queryset.extra(select=select,
+                                  select_params=params + params).order_by(
+                null_alias, ordering)
+
         if not is_gfk(related_field):
             query_name = related_field.related_query_name()
 
@@ -117,10 +345,15 @@ class RatingsQuerySet(QuerySet):
 
 
 class _RatingsDescriptor(models.Manager):
-    def __init__(self, rated_model, rating_model, rating_field):
+    def __init__(self, rated_model, rating_model, rating_field,
+                 aggregate_model=None):
         self.rated_model = rated_model
         self.rating_model = rating_model
         self.rating_field = rating_field
+        self.aggregate_model = aggregate_model
+        # resolved once, as the rated model is set up
+        self.content_field = get_content_object_field(rating_model)
+        self._manager_classes = {}
 
     def __get__(self, instance, instance_type=None):
         if instance is None:
@@ -152,10 +385,37 @@ class _RatingsDescriptor(models.Manager):
 
     def create_manager(self, instance, superclass):
         """
-        Dynamically create a RelatedManager to handle the back side of the (G)FK
+        Returns a RelatedManager to handle the back side of the (G)FK
         """
+        manager = self.related_manager_class(superclass)()
+        manager.instance = instance
+        manager.core_filters = self.rating_model.lookup_kwargs(instance)
+        manager.model = self.rating_model
+        return manager
+
+    def related_manager_class(self, superclass):
+        """
+        Returns the RelatedManager class for superclass, created once per
+        descriptor and superclass rather than on every attribute access
+        """
+        try:
+            return self._manager_classes[superclass]
+        except KeyError:
+            pass
+
         rel_model = self.rating_model
         rated_model = self.rated_model
+        aggregate_model = self.aggregate_model
+        content_field = self.content_field
+
+        def adjust_aggregate(target, added=(), removed=()):
+            if aggregate_model is not None and (added or removed):
+                aggregate_model.adjust(
+                    target,
+                    len(added) - len(removed),
+                    sum(added) - sum(removed),
+                    sum(score * score for score in added) -
+                    sum(score * score for score in removed))
 
         class RelatedManager(superclass):
             def get_query_set(self):
@@ -163,106 +423,526 @@ class _RatingsDescriptor(models.Manager):
                 return qs.filter(**(self.core_filters))
 
             def add(self, *objs):
-                lookup_kwargs = rel_model.lookup_kwargs(instance)
+                lookup_kwargs = self.core_filters
                 for obj in objs:
                     if not isinstance(obj, self.model):
                         raise TypeError("'%s' instance expected" %
                                         self.model._meta.object_name)
+                    if aggregate_model is not None and obj.pk is not None:
+                        # the rating may be moving over from another object
+                        try:
+                            old = rel_model._default_manager.get(pk=obj.pk)
+                        except rel_model.DoesNotExist:
+                            pass
+                        else:
+                            adjust_aggregate(
+                                getattr(old, content_field.name),
+                                removed=[old.score])
                     for (k, v) in lookup_kwargs.iteritems():
                         setattr(obj, k, v)
                     obj.save()
+                    adjust_aggregate(self.instance, [obj.score])
             add.alters_data = True
 
             def create(self, **kwargs):
-                kwargs.update(rel_model.lookup_kwargs(instance))
-                return super(RelatedManager, self).create(**kwargs)
+                kwargs.update(self.core_filters)
+                obj = super(RelatedManager, self).create(**kwargs)
+                adjust_aggregate(self.instance, [obj.score])
+                return obj
             create.alters_data = True
 
             def get_or_create(self, **kwargs):
-                kwargs.update(rel_model.lookup_kwargs(instance))
-                return super(RelatedManager, self).get_or_create(**kwargs)
+                kwargs.update(self.core_filters)
+                obj, created = super(RelatedManager, self).get_or_create(
+                    **kwargs)
+                if created:
+                    adjust_aggregate(self.instance, [obj.score])
+                return obj, created
             get_or_create.alters_data = True
 
             def remove(self, *objs):
+                scores = dict(self.filter(pk__in=[obj.pk for obj in objs])
+                                  .values_list('pk', 'score'))
                 for obj in objs:
                     # Is obj actually part of this descriptor set?
-                    if obj in self.all():
+                    if obj.pk in scores:
+                        # delete() clears obj.pk
+                        score = scores[obj.pk]
                         obj.delete()
+                        adjust_aggregate(self.instance, removed=[score])
                     else:
                         raise rel_model.DoesNotExist(
-                            "%r is not related to %r." % (obj, instance))
+                            "%r is not related to %r." % (obj, self.instance))
             remove.alters_data = True
 
             def clear(self):
                 self.all().delete()
+                DirtyItem.mark(self.instance)
+                if aggregate_model is not None:
+                    aggregate_model._default_manager.filter(
+                        **aggregate_model.lookup_kwargs(self.instance)
+                    ).delete()
+                    if UPDATE_LEADERBOARDS:
+                        Leaderboard.update_object(self.instance, None)
             clear.alters_data = True
 
+            @instrumented()
             def rate(self, user, score):
-                rating, created = self.get_or_create(user=user)
-                if created or score != rating.score:
-                    rating.score = score
-                    rating.save()
+                # an invalid score is refused before anything is written
+                score = rel_model._meta.get_field('score').to_python(score)
+                kwargs = self.core_filters
+                with atomic():
+                    # the rating is locked, so concurrent votes of the user
+                    # do not remove the same previous score from the totals
+                    rating, created = self.select_for_update().get_or_create(
+                        user=user, defaults={'score': score}, **kwargs)
+                    if created:
+                        adjust_aggregate(self.instance, [score])
+                    elif score != rating.score:
+                        adjust_aggregate(self.instance, [score],
+                                         [rating.score])
+                        rating.score = score
+                        rating.save()
+                self.instance.__dict__.pop('_rating_scores_cache', None)
+                ratings_cache.invalidate_user(user)
+                ratings_cache.invalidate_item(self.instance)
                 return rating
 
+            @instrumented()
+            def upsert(self, user, score):
+                """
+                Like rate(), but stores the score with a single statement
+                where the database supports it, and returns nothing
+                """
+                score = rel_model._meta.get_field('score').to_python(score)
+                rating = rel_model(user=user, score=score,
+                                   **self.core_filters)
+                rating.hashed = rating.generate_hash()
+                rating.item_key = rating.generate_item_key()
+                # stored totals need the previous score, and save signals
+                # the saved rating, so they take the slower path
+                if (aggregate_model is not None or
+                        has_save_receivers(rel_model) or
+                        not upsert_row(rating, ('user', 'hashed'),
+                                       ('score', 'updated'))):
+                    self.rate(user, score)
+                    return
+                self.instance.__dict__.pop('_rating_scores_cache', None)
+                ratings_cache.invalidate_user(user)
+                ratings_cache.invalidate_item(self.instance)
+                DirtyItem.mark(self.instance)
+            upsert.alters_data = True
+
+            @instrumented()
             def unrate(self, user):
-                return self.filter(user=user,
-                                   **rel_model.lookup_kwargs(instance)
-                                   ).delete()
+                ratings = self.filter(user=user,
+                                      **self.core_filters)
+                if aggregate_model is not None:
+                    scores = list(ratings.values_list('score', flat=True))
+                    adjust_aggregate(self.instance, removed=scores)
+                self.instance.__dict__.pop('_rating_scores_cache', None)
+                ratings_cache.invalidate_user(user)
+                ratings_cache.invalidate_item(self.instance)
+                DirtyItem.mark(self.instance)
+                return ratings.delete()
+
+            def arate(self, user, score):
+                """
+                Runs rate() in a background thread, returning a result whose
+                get() returns the rating
+                """
+                return run_in_background(self.rate, user, score)
+            arate.alters_data = True
+
+            def aunrate(self, user):
+                return run_in_background(self.unrate, user)
+            aunrate.alters_data = True
+
+            def get_aggregate(self):
+                return aggregate_model.get_for(self.instance)
 
             def perform_aggregation(self, aggregator):
                 score = self.all().aggregate(agg=aggregator('score'))
                 return score['agg']
 
-            def cumulative_score(self):
+            def pending_totals(self):
+                # the number of ratings and their total score, counting the
+                # votes still waiting in the vote buffer
+                if aggregate_model is not None:
+                    totals = self.get_aggregate()
+                    num, total = totals.num_ratings, totals.total_score
+                else:
+                    totals = self.aggregate(num=models.Count('id'),
+                                            total=models.Sum('score'))
+                    num, total = totals['num'], totals['total'] or 0
+
+                pending = pending_votes(self.instance)
+                if pending:
+                    stored = dict(self.filter(user__in=pending.keys())
+                                      .values_list('user', 'score'))
+                    for user_id, score in pending.iteritems():
+                        if user_id in stored:
+                            num -= 1
+                            total -= stored[user_id]
+                        if score is not None:
+                            num += 1
+                            total += score
+                return num, total
+
+            @instrumented()
+            def cumulative_score(self, include_pending=False):
                 # simply the sum of all scores, useful for +1/-1
+                if include_pending:
+                    num, total = self.pending_totals()
+                    return total if num else None
+                if aggregate_model is not None:
+                    return self.get_aggregate().cumulative_score()
                 return self.perform_aggregation(models.Sum)
 
-            def average_score(self):
+            @instrumented()
+            def average_score(self, include_pending=False):
                 # the average of all the scores, useful for 1-5
+                if include_pending:
+                    num, total = self.pending_totals()
+                    return float(total) / num if num else None
+                if aggregate_model is not None:
+                    return self.get_aggregate().average_score()
                 return self.perform_aggregation(models.Avg)
 
+            def acumulative_score(self, include_pending=False):
+                return run_in_background(self.cumulative_score,
+                                         include_pending)
+
+            def aaverage_score(self, include_pending=False):
+                return run_in_background(self.average_score, include_pending)
+
+            @instrumented()
             def standard_deviation(self):
                 # the standard deviation of all the scores, useful for 1-5
+                if aggregate_model is not None:
+                    return self.get_aggregate().standard_deviation()
                 return self.perform_aggregation(models.StdDev)
 
+            @instrumented()
             def variance(self):
                 # the variance of all the scores, useful for 1-5
+                if aggregate_model is not None:
+                    return self.get_aggregate().variance()
                 return self.perform_aggregation(models.Variance)
 
+            @instrumented()
             def similar_items(self):
-                return SimilarItem.objects.get_for_item(instance)
+                return SimilarItem.objects.cached_for_item(self.instance)
 
-        manager = RelatedManager()
-        manager.core_filters = rel_model.lookup_kwargs(instance)
-        manager.model = rel_model
-
-        return manager
+        self._manager_classes[superclass] = RelatedManager
+        return RelatedManager
 
     def get_content_object_field(self):
-        if not hasattr(self, '_content_object_field'):
-            self._content_object_field = get_content_object_field(self.rating_model)
-        return self._content_object_field
+        return self.content_field
 
     @property
     def is_gfk(self):
         return is_gfk(self.get_content_object_field())
 
-    def update_similar_items(self):
+    @instrumented()
+    def update_similar_items(self, engine='sql', incremental=False,
+                             workers=1, bands=None, snapshot=None):
         from ratings.utils import calculate_similar_items
-        calculate_similar_items(self.all())
+        calculate_similar_items(self.all(), engine=engine,
+                                incremental=incremental, workers=workers,
+                                bands=bands, snapshot=snapshot)
+
+    @instrumented()
+    def export_snapshot(self, path):
+        """
+        Write the ratings to a snapshot file, see :mod:`ratings.snapshot`
+        """
+        from ratings.snapshot import write_snapshot
+        write_snapshot(self.all(), path)
+
+    @instrumented(rows=sum)
+    def rate_many(self, ratings, send_signals=True, batch_size=500):
+        """
+        Store an iterable of (object, user, score) ratings, creating or
+        updating them with a few queries per batch rather than several per
+        rating.  When an object is rated more than once by the same user the
+        last score wins.  With send_signals=False the pre_save and post_save
+        signals of the rating model are not sent.
+
+        Returns the number of ratings created and updated.
+        """
+        created = updated = 0
+        for chunk in chunked(ratings, batch_size):
+            with atomic():
+                c, u = self._rate_chunk(chunk, send_signals)
+            created += c
+            updated += u
+        return created, updated
+    rate_many.alters_data = True
+
+    def _rate_chunk(self, chunk, send_signals):
+        rel_model = self.rating_model
+        manager = rel_model._default_manager
+
+        scores = {}
+        objects = {}
+        users = {}
+        for obj, user, score in chunk:
+            if not isinstance(obj, self.rated_model):
+                raise TypeError("'%s' instance expected" %
+                                self.rated_model._meta.object_name)
+            hashed = rel_model.hash_for(obj)
+            objects[hashed] = obj
+            users[user.pk] = user
+            scores[hashed, user.pk] = score
+
+        # the voted hashes of each user, looked up a user at a time so only
+        # the voted pairs are fetched and few parameters are bound at once
+        voted = {}
+        for hashed, user_id in scores:
+            voted.setdefault(user_id, []).append(hashed)
+
+        existing = {}
+        for user_id, hashes in voted.iteritems():
+            for hash_chunk in chunked(hashes, MAX_QUERY_PARAMS - 1):
+                rows = manager.filter(user=user_id, hashed__in=hash_chunk)
+                for pk, hashed, score in rows.values_list('pk', 'hashed',
+                                                          'score'):
+                    existing[hashed, user_id] = (pk, score)
+
+        to_create = []
+        to_update = {}
+        updated = []
+        added = {}
+        removed = {}
+        for (hashed, user_id), score in scores.iteritems():
+            instance = rel_model(user=users[user_id], score=score,
+                                 hashed=hashed,
+                                 item_key=rel_model.item_key_for(
+                                     objects[hashed]),
+                                 **rel_model.lookup_kwargs(objects[hashed]))
+            if (hashed, user_id) in existing:
+                instance.pk, old_score = existing[hashed, user_id]
+                if old_score == score:
+                    continue
+                to_update.setdefault(score, []).append(instance.pk)
+                removed.setdefault(hashed, []).append(old_score)
+                updated.append(instance)
+            else:
+                to_create.append(instance)
+            added.setdefault(hashed, []).append(score)
+
+        if send_signals:
+            for instance in to_create + updated:
+                models.signals.pre_save.send(sender=rel_model,
+                                             instance=instance, raw=False,
+                                             using=manager.db)
+
+        # each row binds a parameter per column
+        rows_per_insert = MAX_QUERY_PARAMS // len(rel_model._meta.local_fields)
+        for create_chunk in chunked(to_create, rows_per_insert):
+            manager.bulk_create(create_chunk)
+        # there is no bulk update, but ratings use few distinct scores, so
+        # one update per score is close to one per batch
+        now = timezone.now()
+        for score, pks in to_update.iteritems():
+            for pk_chunk in chunked(pks, MAX_QUERY_PARAMS - 2):
+                manager.filter(pk__in=pk_chunk).update(score=score,
+                                                       updated=now)
+
+        if send_signals:
+            for instances, created in ((to_create, True), (updated, False)):
+                for instance in instances:
+                    models.signals.post_save.send(sender=rel_model,
+                                                  instance=instance,
+                                                  created=created, raw=False,
+                                                  using=manager.db)
+
+        changed = [objects[hashed] for hashed in added]
+        if self.aggregate_model is not None:
+            for hashed in added:
+                new, old = added[hashed], removed.get(hashed, [])
+                self.aggregate_model.adjust(
+                    objects[hashed], len(new) - len(old),
+                    sum(new) - sum(old),
+                    sum(x * x for x in new) - sum(x * x for x in old))
+        DirtyItem.mark_many(changed)
+        for obj in changed:
+            obj.__dict__.pop('_rating_scores_cache', None)
+            ratings_cache.invalidate_item(obj)
+        for user in users.itervalues():
+            ratings_cache.invalidate_user(user)
+
+        return len(to_create), len(updated)
+
+    @instrumented()
+    def rebuild_aggregates(self):
+        """
+        Recalculate the stored totals of every rated object from scratch
+        """
+        if self.aggregate_model is None:
+            return
 
+        field = self.get_content_object_field()
+        if is_gfk(field):
+            names = [field.ct_field, field.fk_field]
+        else:
+            names = [field.name]
+        attnames = [self.aggregate_model._meta.get_field(name).attname
+                    for name in names]
+
+        totals = {}
+        rows = self.all().values_list(*(names + ['score']))
+        for row in rows.iterator():
+            key, score = row[:-1], row[-1]
+            acc = totals.get(key)
+            if acc is None:
+                acc = totals[key] = [0, 0, 0]
+            acc[0] += 1
+            acc[1] += score
+            acc[2] += score * score
+
+        aggregates = self.aggregate_model._default_manager
+        with atomic():
+            aggregates.filter(
+                **self.aggregate_model.base_kwargs(self.rated_model)).delete()
+            for chunk in chunked(totals.iteritems(), 500):
+                aggregates.bulk_create([
+                    self.aggregate_model(num_ratings=num_ratings,
+                                         total_score=total_score,
+                                         total_squares=total_squares,
+                                         **dict(zip(attnames, object_key)))
+                    for object_key, (num_ratings, total_score, total_squares)
+                    in chunk])
+
+    @instrumented()
+    def prefetch_user_scores(self, objects, user):
+        """
+        Loads the scores user has given to each of objects with a single
+        query and attaches them to the objects, where the ``rating_score`` and
+        ``has_rated`` template filters will find them
+        """
+        objects = list(objects)
+        field = self.get_content_object_field()
+        key = is_gfk(field) and field.fk_field or field.name
+
+        scores = {}
+        for chunk in chunked([obj.pk for obj in objects], 500):
+            ratings = self.filter(user=user, **{'%s__in' % key: chunk})
+            scores.update(ratings.values_list(key, 'score'))
+
+        for obj in objects:
+            cache = obj.__dict__.setdefault('_rating_scores_cache', {})
+            cache[user.pk] = scores.get(obj.pk)
+        return objects
+
+    @instrumented()
     def similar_items(self, item):
-        return SimilarItem.objects.get_for_item(item)
+        return SimilarItem.objects.cached_for_item(item)
 
+    @instrumented()
     def recommended_items(self, user):
-        return recommended_items(self.all(), user)
+        key = 'recommended:%s.%s:%s' % (self.rated_model._meta,
+                                        self.rating_field, user.pk)
+        return ratings_cache.cached(key, [ratings_cache.user_key(user)],
+                                    lambda: recommended_items(self.all(), user))
+
+    def arecommended_items(self, user):
+        return run_in_background(self.recommended_items, user)
 
     def order_by_rating(self, aggregator=models.Sum, descending=True,
-                        queryset=None, alias='score'):
+                        queryset=None, alias='score', half_life=None,
+                        window=None):
+        # instrumented by the queryset, so calls are counted once
         return self.all().order_by_rating(
-            aggregator, descending, queryset, alias
+            aggregator, descending, queryset, alias, half_life, window
         )
 
+    @instrumented()
+    def update_leaderboard(self, aggregator=models.Sum, size=None):
+        """
+        Store the ``size`` objects ranked highest by order_by_rating(), which
+        top_rated() reads from
+        """
+        size = size or LEADERBOARD_SIZE
+        rows = self.order_by_rating(aggregator, queryset=self._rated_objects())
+        rows = rows.values_list('pk', 'score').iterator()
+        # one more than fits, to know the best score left off the board
+        entries = list(itertools.islice(
+            ((pk, score) for pk, score in rows if score is not None),
+            size + 1))
+
+        ctype = ContentType.objects.get_for_model(self.rated_model)
+        with atomic():
+            leaderboard, created = Leaderboard.objects.get_or_create(
+                content_type=ctype, board=aggregator.name.lower(),
+                defaults={'size': size})
+            leaderboard.size = size
+            leaderboard.threshold = None
+            if len(entries) > size:
+                leaderboard.threshold = entries.pop()[1]
+            leaderboard.save()
+
+            leaderboard.entries.all().delete()
+            LeaderboardEntry.objects.bulk_create([
+                LeaderboardEntry(leaderboard=leaderboard, object_id=pk,
+                                 score=score)
+                for pk, score in entries])
+        return leaderboard
+
+    def _rated_objects(self):
+        field = self.get_content_object_field()
+        key = is_gfk(field) and field.fk_field or field.name
+        return self.rated_model._default_manager.filter(
+            pk__in=self.all().values_list(key))
+
+    @instrumented()
+    def top_rated(self, n=10, offset=0, aggregator=models.Sum):
+        """
+        Returns the objects ranked n to offset + n by aggregator, each with
+        its ``score``, read from the leaderboard stored by
+        update_leaderboard().  Without a leaderboard order_by_rating() is
+        used instead, and objects which dropped off a board since it was
+        stored are ranked by order_by_rating() after the ones left on it.
+        """
+        ctype = ContentType.objects.get_for_model(self.rated_model)
+        board = aggregator.name.lower()
+        entries = list(LeaderboardEntry.objects.filter(
+            leaderboard__content_type=ctype,
+            leaderboard__board=board,
+        ).order_by('-score', 'object_id').values_list(
+            'object_id', 'score')[offset:offset + n])
+
+        objects = self.rated_model._default_manager.in_bulk(
+            [object_id for object_id, score in entries])
+        results = []
+        for object_id, score in entries:
+            if object_id in objects:
+                obj = objects[object_id]
+                obj.score = score
+                results.append(obj)
+        if len(entries) == n:
+            return results
+
+        try:
+            leaderboard = Leaderboard.objects.get(content_type=ctype,
+                                                  board=board)
+        except Leaderboard.DoesNotExist:
+            return list(self.order_by_rating(aggregator)[offset:offset + n])
+        if leaderboard.threshold is None:
+            # every rated object is on the board
+            return results
+
+        # every object off the board scores at most the threshold, so they
+        # rank after the ones on it
+        on_board = list(leaderboard.entries.values_list('object_id',
+                                                        flat=True))
+        start = max(offset - len(on_board), 0)
+        rest = self.order_by_rating(
+            aggregator, queryset=self._rated_objects().exclude(
+                pk__in=on_board))
+        return results + list(rest[start:start + n - len(entries)])
+
 
 class SimilarItemManager(models.Manager):
     def get_for_item(self, instance):
@@ -270,6 +950,16 @@ class SimilarItemManager(models.Manager):
         qs = self.filter(content_type=ctype, object_id=instance.pk)
         return qs.order_by('-score')
 
+    def cached_for_item(self, instance):
+        """
+        Like get_for_item, but served from the results cache when
+        RATINGS_CACHE is configured, until the ratings of the item change
+        """
+        ctype = ContentType.objects.get_for_model(instance)
+        key = 'similar:%s:%s' % (ctype.pk, instance.pk)
+        return ratings_cache.cached(key, [ratings_cache.item_key(instance)],
+                                    lambda: self.get_for_item(instance))
+
 
 class SimilarItem(models.Model):
     content_type = models.ForeignKey(ContentType, related_name='similar_items')
@@ -288,3 +978,127 @@ class SimilarItem(models.Model):
 
     def __unicode__(self):
         return u'%s (%s)' % (self.similar_object, self.score)
+
+
+class Leaderboard(models.Model):
+    """
+    The objects of a model ranked highest by one aggregator over their
+    ratings, stored by update_leaderboard() and read by top_rated()
+    """
+    content_type = models.ForeignKey(ContentType, related_name='leaderboards')
+    board = models.CharField(max_length=20)
+    size = models.IntegerField()
+
+    # no object missing from the board scores higher than this, None when
+    # every rated object is on the board
+    threshold = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (('content_type', 'board'),)
+
+    def __unicode__(self):
+        return u'%s by %s' % (self.content_type, self.board)
+
+    @classmethod
+    def update_object(cls, instance, totals):
+        """
+        Move instance on the leaderboards of its model ranked by sum, average
+        or count, given its stored totals after its ratings changed
+        """
+        ctype = ContentType.objects.get_for_model(instance)
+        leaderboards = cls._default_manager.filter(
+            content_type=ctype, board__in=('sum', 'avg', 'count'))
+        for leaderboard in leaderboards:
+            score = None
+            if totals is not None:
+                score = {
+                    'sum': totals.cumulative_score,
+                    'avg': totals.average_score,
+                    'count': lambda: totals.num_ratings or None,
+                }[leaderboard.board]()
+            leaderboard.place(instance.pk, score)
+
+    def place(self, object_id, score):
+        """
+        Store the new score of an object, keeping the board ordered like a
+        rebuilt one would be: objects only stay on or enter it while they
+        score higher than every object missing from it
+        """
+        entries = self.entries.all()
+        if score is None or (self.threshold is not None and
+                             score <= self.threshold):
+            entries.filter(object_id=object_id).delete()
+            return
+
+        if entries.filter(object_id=object_id).update(score=score):
+            return
+        try:
+            with atomic():
+                self.entries.create(object_id=object_id, score=score)
+        except IntegrityError:
+            entries.filter(object_id=object_id).update(score=score)
+            return
+
+        if entries.count() > self.size:
+            lowest = entries.order_by('score', '-object_id')[0]
+            lowest.delete()
+            self.threshold = lowest.score
+            Leaderboard.objects.filter(pk=self.pk).update(
+                threshold=lowest.score)
+
+
+class LeaderboardEntry(models.Model):
+    leaderboard = models.ForeignKey(Leaderboard, related_name='entries')
+    object_id = models.IntegerField()
+    score = models.FloatField(db_index=True)
+
+    class Meta:
+        unique_together = (('leaderboard', 'object_id'),)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.object_id, self.score)
+
+
+class DirtyItem(models.Model):
+    """
+    An object whose ratings changed since its similar items were last
+    calculated
+    """
+    content_type = models.ForeignKey(ContentType, related_name='dirty_items')
+    object_id = models.IntegerField()
+    content_object = GenericForeignKey('content_type', 'object_id')
+
+    def __unicode__(self):
+        return u'%s' % self.content_object
+
+    @classmethod
+    def mark(cls, instance):
+        if not TRACK_DIRTY_ITEMS:
+            return
+        ctype = ContentType.objects.get_for_model(instance)
+        marked = cls._default_manager.filter(content_type=ctype,
+                                             object_id=instance.pk)
+        # duplicates from concurrent writers are harmless, the log is read
+        # as a set and cleared as a whole
+        if not marked.exists():
+            cls._default_manager.create(content_type=ctype,
+                                        object_id=instance.pk)
+
+    @classmethod
+    def mark_many(cls, instances):
+        """
+        Mark several objects with one query per content type
+        """
+        if not TRACK_DIRTY_ITEMS:
+            return
+        by_ctype = {}
+        for instance in instances:
+            ctype = ContentType.objects.get_for_model(instance)
+            by_ctype.setdefault(ctype, set()).add(instance.pk)
+        for ctype, object_ids in by_ctype.iteritems():
+            marked = cls._default_manager.filter(content_type=ctype,
+                                                 object_id__in=object_ids)
+            object_ids -= set(marked.values_list('object_id', flat=True))
+            cls._default_manager.bulk_create([
+                cls(content_type=ctype, object_id=object_id)
+                for object_id in object_ids])
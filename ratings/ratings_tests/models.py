@@ -1,6 +1,7 @@
 from django.db import models
 
-from ratings.models import Ratings, RatedItemBase
+from ratings.models import Ratings, RatedItemBase, RatingAggregate, \
+    RatingAggregateBase
 
 
 class Food(models.Model):
@@ -23,3 +24,29 @@ class Beverage(models.Model):
     
     def __unicode__(self):
         return self.name
+
+
+class Snack(models.Model):
+    name = models.CharField(max_length=50)
+
+    ratings = Ratings(aggregate_model=RatingAggregate)
+
+    def __unicode__(self):
+        return self.name
+
+
+class JuiceRating(RatedItemBase):
+    content_object = models.ForeignKey('Juice')
+
+
+class JuiceRatingAggregate(RatingAggregateBase):
+    content_object = models.OneToOneField('Juice')
+
+
+class Juice(models.Model):
+    name = models.CharField(max_length=50)
+
+    ratings = Ratings(JuiceRating, JuiceRatingAggregate)
+
+    def __unicode__(self):
+        return self.name
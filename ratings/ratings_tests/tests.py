@@ -3,17 +3,38 @@ import django
 
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
+from django.db import models, IntegrityError
+from django.db.models.query import QuerySet
 from django.template import Template, Context
-from django.test import TestCase
-
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+import datetime
+import json
+import logging
+import os
+import tempfile
 import unittest
 
-from ratings.models import RatedItem
-from ratings.ratings_tests.models import Food, Beverage, BeverageRating
+from ratings.models import RatedItem, SimilarItem, DirtyItem
+from ratings.ratings_tests.models import Food, Beverage, BeverageRating, \
+    Snack, Juice, JuiceRating
 from ratings.utils import sim_euclidean_distance, sim_pearson_correlation, top_matches, recommendations, calculate_similar_items, recommended_items
+from ratings.utils import sim_euclidean_many, sim_pearson_many
+from ratings.utils import BayesianAverage, WilsonScore
+from ratings import background as ratings_background
+from ratings import buffer as ratings_buffer
+from ratings import cache as ratings_cache
+from ratings import instrumentation as ratings_instrumentation
+from ratings import models as ratings_models
 from ratings import utils as ratings_utils
 from ratings import views as ratings_views
+from ratings.snapshot import RatingsSnapshot
+from ratings.templatetags.ratings_tags import rating_score
 
 
 def skipUnlessDB(engine):
@@ -170,6 +191,67 @@ class RatingsTestCase(TestCase):
         self.assertEqual(rating1.pk, rating1_alt.pk)
         self.assertEqual(rating1_alt.score, 1000000)
 
+    def test_manager_class_cached(self):
+        manager1 = self.item1.ratings
+        manager2 = self.item2.ratings
+        self.assertTrue(type(manager1) is type(manager2))
+        self.assertEqual(manager1.instance, self.item1)
+        self.assertEqual(manager2.instance, self.item2)
+
+        descriptor = self.rated_model.ratings
+        self.assertTrue(type(descriptor.delete_manager(self.item1)) is
+                        type(descriptor.delete_manager(self.item2)))
+
+        manager1.rate(self.john, 1)
+        self.assertEqual(manager1.count(), 1)
+        self.assertEqual(manager2.count(), 0)
+
+    def test_upsert(self):
+        self.item1.ratings.upsert(self.john, 1)
+        self.item1.ratings.upsert(self.jane, -1)
+        rating = self.item1.ratings.get(user=self.john)
+
+        self.item1.ratings.upsert(self.john, 5)
+        self.assertEqual(self.item1.ratings.count(), 2)
+        self.assertEqual(self.item1.ratings.get(user=self.john).pk, rating.pk)
+        self.assertEqual(self.item1.ratings.get(user=self.john).score, 5)
+        self.assertEqual(self.item1.ratings.cumulative_score(), 4)
+
+        # a user can only rate an object once
+        duplicate = self.rating_model(user=self.john, score=2)
+        self.assertRaises(IntegrityError, self.item1.ratings.add, duplicate)
+
+    def test_rate_invalid_score(self):
+        # nothing is written for a score that cannot be stored
+        self.assertRaises(ValidationError, self.item1.ratings.rate,
+                          self.john, 'x')
+        self.assertEqual(self.item1.ratings.count(), 0)
+
+        self.item1.ratings.rate(self.john, 2)
+        self.item1.ratings.rate(self.john, 3)
+        self.assertEqual(self.item1.ratings.count(), 1)
+        self.assertEqual(self.item1.ratings.cumulative_score(), 3)
+
+    def test_upsert_signals(self):
+        saved = []
+
+        def receiver(sender, instance, created, **kwargs):
+            saved.append((instance.user, instance.score, created))
+        models.signals.post_save.connect(receiver, sender=self.rating_model)
+        self.addCleanup(models.signals.post_save.disconnect, receiver,
+                        sender=self.rating_model)
+
+        # the rate view upserts, which must still send the save signals
+        user = User.objects.create_user('a', 'a', 'a')
+        self.client.login(username='a', password='a')
+        ctype = ContentType.objects.get_for_model(self.rated_model)
+        self.client.post(reverse('ratings_rate_object', args=(
+            ctype.pk, self.item1.pk, 4)))
+        self.item2.ratings.upsert(self.jane, 2)
+        self.item2.ratings.upsert(self.jane, 3)
+        self.assertEqual(saved, [(user, 4, True), (self.jane, 2, True),
+                                 (self.jane, 3, False)])
+
     def test_scoring(self):
         rating1 = self.item1.ratings.rate(self.john, 1)
         rating2 = self.item1.ratings.rate(self.jane, -1)
@@ -214,6 +296,123 @@ class RatingsTestCase(TestCase):
         self.assertEqual(rated_qs[0].score, 2.0)
         self.assertEqual(rated_qs[1].score, 1.0)
 
+    def test_order_by_recent_rating(self):
+        self.item1.ratings.rate(self.john, 5)
+        self.item2.ratings.rate(self.john, 2)
+        self.item2.ratings.rate(self.jane, 2)
+
+        # john rated item1 a month ago
+        month_ago = timezone.now() - datetime.timedelta(days=30)
+        self.item1.ratings.all().update(created=month_ago, updated=month_ago)
+
+        ratings = self.rated_model.ratings
+        rated_qs = ratings.order_by_rating(aggregator=models.Avg)
+        self.assertEqual(list(rated_qs), [self.item1, self.item2])
+
+        # decayed, item1 counts for nothing any more
+        rated_qs = ratings.order_by_rating(half_life=datetime.timedelta(days=1))
+        self.assertEqual(list(rated_qs), [self.item2, self.item1])
+        self.assertAlmostEqual(rated_qs[0].score, 4, 3)
+        self.assertAlmostEqual(rated_qs[1].score, 0, 3)
+
+        # a weighted average is not affected by the age of a single rating
+        rated_qs = ratings.order_by_rating(aggregator=models.Avg,
+                                           half_life=datetime.timedelta(days=1))
+        self.assertEqual(list(rated_qs), [self.item1, self.item2])
+        self.assertAlmostEqual(rated_qs[0].score, 5)
+
+        # only the ratings of the past week
+        rated_qs = ratings.all().order_by_rating(
+            window=datetime.timedelta(days=7), alias='weekly')
+        self.assertEqual(list(rated_qs), [self.item2, self.item1])
+        scores = dict((item.pk, item.weekly) for item in rated_qs)
+        self.assertEqual(scores, {self.item1.pk: None, self.item2.pk: 4})
+
+        # objects without ratings in the window rank last either way
+        week = datetime.timedelta(days=7)
+        rated_qs = ratings.order_by_rating(aggregator=models.Avg, window=week)
+        self.assertEqual(list(rated_qs), [self.item2, self.item1])
+        self.assertEqual(rated_qs[1].score, None)
+
+        rated_qs = ratings.order_by_rating(window=week, descending=False)
+        self.assertEqual(list(rated_qs), [self.item2, self.item1])
+
+        # the ratings queryset still restricts the ratings counted, and
+        # objects without ratings in it are left out
+        rated_qs = ratings.filter(user=self.jane).order_by_rating(window=week)
+        scores = dict((item.pk, item.score) for item in rated_qs)
+        self.assertEqual(scores, {self.item2.pk: 2})
+
+        # a negative score still ranks above no score
+        self.item2.ratings.rate(self.john, -3)
+        for descending in (True, False):
+            rated_qs = ratings.order_by_rating(window=week,
+                                               descending=descending)
+            self.assertEqual([(obj, obj.score) for obj in rated_qs],
+                             [(self.item2, -1), (self.item1, None)])
+
+        self.assertRaises(ValueError, ratings.order_by_rating,
+                          aggregator=models.Max,
+                          half_life=datetime.timedelta(days=1))
+
+    def test_order_by_confidence(self):
+        users = [self.john, self.jane] + [
+            User.objects.create_user(name, name, name) for name in 'ab']
+        ratings = self.rated_model.ratings
+
+        # one vote up against three up and one down
+        self.item1.ratings.rate(self.john, 1)
+        for user, score in zip(users, (1, 1, 1, -1)):
+            self.item2.ratings.rate(user, score)
+
+        rated_qs = ratings.order_by_rating(aggregator=models.Avg)
+        self.assertEqual(list(rated_qs), [self.item1, self.item2])
+
+        rated_qs = ratings.order_by_rating(aggregator=WilsonScore())
+        self.assertEqual(list(rated_qs), [self.item2, self.item1])
+        self.assertAlmostEqual(rated_qs[0].score, 0.3006, 4)
+        self.assertAlmostEqual(rated_qs[1].score, 0.2065, 4)
+
+        # a single five star rating against four of four and a half
+        self.item1.ratings.rate(self.john, 5)
+        for user in users:
+            self.item2.ratings.rate(user, 4.5)
+
+        rated_qs = ratings.order_by_rating(
+            aggregator=BayesianAverage(prior=3, weight=2))
+        self.assertEqual(list(rated_qs), [self.item2, self.item1])
+        self.assertAlmostEqual(rated_qs[0].score, 4)
+        self.assertAlmostEqual(rated_qs[1].score, 11 / 3.0)
+
+        self.assertRaises(ValueError, BayesianAverage, weight=0)
+
+    def test_leaderboard(self):
+        self.item1.ratings.rate(self.john, 1)
+        self.item2.ratings.rate(self.john, 3)
+        self.item2.ratings.rate(self.jane, 2)
+        ratings = self.rated_model.ratings
+
+        # without a leaderboard the ratings are aggregated on every call
+        self.assertEqual(ratings.top_rated(), [self.item2, self.item1])
+
+        ratings.update_leaderboard(size=1)
+        with self.assertNumQueries(2):
+            top = ratings.top_rated(n=1)
+        self.assertEqual(top, [self.item2])
+        self.assertEqual(top[0].score, 5)
+
+        # objects off the board are ranked after the ones on it
+        top = ratings.top_rated()
+        self.assertEqual([(obj, obj.score) for obj in top],
+                         [(self.item2, 5), (self.item1, 1)])
+        self.assertEqual(ratings.top_rated(offset=1), [self.item1])
+        self.assertEqual(ratings.top_rated(offset=2), [])
+
+        ratings.update_leaderboard(models.Avg)
+        top = ratings.top_rated(aggregator=models.Avg)
+        self.assertEqual([(obj, obj.score) for obj in top],
+                         [(self.item2, 2.5), (self.item1, 1)])
+
     @skipUnlessDB('postgres')
     def test_order_postgresql(self):
         """
@@ -438,6 +637,25 @@ class RatingsTestCase(TestCase):
         self.item1.ratings.rate(self.john, 10)
         self.assertEqual(t.render(c), 'True')
 
+    def test_prefetch_user_scores(self):
+        self.item1.ratings.rate(self.john, 3)
+
+        t = Template('{% load ratings_tags %}'
+                     '{% prefetch_user_scores items user %}'
+                     '{% for obj in items %}'
+                     '{{ obj|rating_score:user }}|{{ user|has_rated:obj }};'
+                     '{% endfor %}')
+        items = list(self.rated_model.objects.filter(pk__in=[1, 2]).order_by('pk'))
+        c = Context({'items': items, 'user': self.john})
+
+        with self.assertNumQueries(1):
+            self.assertEqual(t.render(c), '3.0|True;None|False;')
+
+        # rating an object drops the scores attached to it
+        items[1].ratings.rate(self.john, 5)
+        self.assertEqual(rating_score(items[1], self.john), 5.0)
+        self.assertEqual(rating_score(items[0], self.john), 3.0)
+
     def test_rate_url(self):
         t = Template('{% load ratings_tags %}{{ obj|rate_url:score }}')
         c = Context({'obj': self.item1, 'score': 2})
@@ -580,17 +798,467 @@ class RatingsTestCase(TestCase):
         else:
             self.assertEqual(resp.url, 'http://testserver/')
 
+    def test_batch_rating_view(self):
+        url = reverse('ratings_rate_objects')
+        ctype = ContentType.objects.get_for_model(self.rated_model)
+        self.item2.ratings.rate(self.john, 1)
+
+        def post(votes):
+            return self.client.post(url, json.dumps(votes),
+                                    content_type='application/json')
+
+        # must be logged in and POST
+        self.assertEqual(post([]).status_code, 302)
+        self.john.set_password('john')
+        self.john.save()
+        self.client.login(username='john', password='john')
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertEqual(self.client.post(url, 'votes',
+            content_type='application/json').status_code, 400)
+        self.assertEqual(post({}).status_code, 400)
+
+        resp = post([
+            {'ct': ctype.pk, 'pk': self.item1.pk, 'score': 3},
+            {'ct': ctype.pk, 'pk': self.item2.pk, 'score': 5},
+            {'ct': ctype.pk, 'pk': self.item2.pk, 'score': None},
+            {'ct': ctype.pk, 'pk': 999, 'score': 1},
+            {'ct': 999, 'pk': self.item1.pk, 'score': 1},
+            {'ct': ctype.pk, 'pk': self.item1.pk, 'score': 'a'},
+            {'ct': ctype.pk, 'pk': self.item1.pk},
+            'vote',
+        ])
+        self.assertEqual(resp.status_code, 200)
+        results = json.loads(resp.content)
+        self.assertEqual([result['success'] for result in results],
+                         [True, True, True, False, False, False, False, False])
+
+        # the last vote for an object wins
+        self.assertEqual(self.item1.ratings.get(user=self.john).score, 3)
+        self.assertEqual(self.item2.ratings.count(), 0)
+
+    def test_buffered_rating_view(self):
+        user = User.objects.create_user('a', 'a', 'a')
+        self.client.login(username='a', password='a')
+
+        ctype = ContentType.objects.get_for_model(self.rated_model)
+        rate_url = reverse('ratings_rate_object', args=(ctype.pk,
+                                                        self.item1.pk, 3))
+        unrate_url = reverse('ratings_unrate_object', args=(ctype.pk,
+                                                            self.item2.pk))
+
+        self.item1.ratings.rate(self.john, 1)
+        self.item2.ratings.rate(self.john, 5)
+        self.item2.ratings.rate(user, 2)
+
+        ratings_buffer.get_buffer().drain()
+        ratings_views.BUFFER_VOTES = True
+        self.addCleanup(setattr, ratings_views, 'BUFFER_VOTES', False)
+
+        # repeated votes of a user are coalesced
+        for url in (rate_url, rate_url, unrate_url):
+            resp = self.client.post(url)
+            self.assertEqual(resp.status_code, 302)
+
+        # nothing is written until the buffer is flushed, but reads can
+        # include the pending votes
+        self.assertEqual(self.item1.ratings.count(), 1)
+        self.assertEqual(self.item2.ratings.count(), 2)
+        self.assertEqual(
+            self.item1.ratings.cumulative_score(include_pending=True), 4)
+        self.assertEqual(
+            self.item1.ratings.average_score(include_pending=True), 2)
+        self.assertEqual(
+            self.item2.ratings.average_score(include_pending=True), 5)
+
+        self.assertEqual(ratings_buffer.flush_votes(), 2)
+        self.assertEqual(self.item1.ratings.get(user=user).score, 3)
+        self.assertEqual(self.item1.ratings.cumulative_score(), 4)
+        self.assertEqual(self.item2.ratings.count(), 1)
+        self.assertEqual(ratings_buffer.pending_votes(self.item1), {})
+        self.assertEqual(ratings_buffer.flush_votes(), 0)
+
+        # the command cannot reach votes kept in the memory of this process
+        self.assertFalse(ratings_buffer.get_buffer().shared)
+        self.assertRaises((CommandError, SystemExit), call_command,
+                          'flush_rating_votes', verbosity=0)
+
+    def test_background(self):
+        self.addCleanup(setattr, ratings_background, 'POOL_SIZE',
+                        ratings_background.POOL_SIZE)
+        ratings_background.POOL_SIZE = 0
+
+        result = self.item1.ratings.arate(self.john, 1)
+        self.assertTrue(result.ready())
+        self.assertEqual(result.get(), self.item1.ratings.get(user=self.john))
+        self.item1.ratings.arate(self.jane, 4).wait()
+
+        self.assertEqual(self.item1.ratings.acumulative_score().get(), 5)
+        self.assertEqual(self.item1.ratings.aaverage_score().get(), 2.5)
+        self.assertEqual(
+            self.rated_model.ratings.arecommended_items(self.john).get(),
+            self.rated_model.ratings.recommended_items(self.john))
+
+        self.item1.ratings.aunrate(self.john).get()
+        self.assertEqual(self.item1.ratings.count(), 1)
+
+        # errors are raised by get()
+        result = ratings_background.run_in_background(int, 'x')
+        self.assertFalse(result.successful())
+        self.assertRaises(ValueError, result.get)
+
+        # nobody waits for the votes of the view, so their errors are logged
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        ratings_background.logger.addHandler(handler)
+        self.addCleanup(ratings_background.logger.removeHandler, handler)
+        ctype = ContentType.objects.get_for_model(self.rated_model)
+        result = ratings_background.run_in_background(
+            ratings_background.rate_object, ctype.pk, self.item2.pk,
+            self.john.pk, 'x')
+        self.assertFalse(result.successful())
+        self.assertEqual(len(records), 1)
+        self.assertTrue(records[0].exc_info)
+
+        # the view stores votes through the same path
+        User.objects.create_user('a', 'a', 'a')
+        self.client.login(username='a', password='a')
+        ratings_views.BACKGROUND_VOTES = True
+        self.addCleanup(setattr, ratings_views, 'BACKGROUND_VOTES', False)
+
+        resp = self.client.post(reverse('ratings_rate_object',
+                                        args=(ctype.pk, self.item2.pk, 3)))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.item2.ratings.get().score, 3)
+
+        resp = self.client.post(reverse('ratings_unrate_object',
+                                        args=(ctype.pk, self.item2.pk)))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.item2.ratings.count(), 0)
+
+    def test_instrumentation(self):
+        events = []
+
+        def receiver(sender, **kwargs):
+            events.append((sender, kwargs['operation'], kwargs['queries'],
+                           kwargs['rows']))
+        ratings_instrumentation.operation_finished.connect(receiver)
+        self.addCleanup(ratings_instrumentation.operation_finished.disconnect,
+                        receiver)
+
+        # nothing is reported until instrumentation is enabled
+        self.item1.ratings.rate(self.john, 1)
+        self.assertEqual(events, [])
+
+        ratings_instrumentation.ENABLED = True
+        self.addCleanup(setattr, ratings_instrumentation, 'ENABLED', False)
+        stats = ratings_instrumentation.get_stats()
+        stats.reset()
+
+        self.item1.ratings.rate(self.jane, 3)
+        self.item1.ratings.average_score()
+        top_rated = self.rated_model.ratings.top_rated(2)
+
+        # nested operations are reported as they finish
+        operations = [(sender, operation) for sender, operation, q, r in events]
+        # operations of the ratings of an object are reported for its model
+        self.assertEqual(operations, [
+            (self.rated_model, 'rate'),
+            (self.rated_model, 'average_score'),
+            (self.rated_model, 'order_by_rating'),
+            (self.rated_model, 'top_rated'),
+        ])
+        self.assertTrue(events[0][2] > 0)
+        self.assertEqual(events[1][2], 1)
+        self.assertTrue(events[3][2] > 0)
+        self.assertEqual(events[0][3], 1)
+        self.assertEqual(events[3][3], len(top_rated))
+
+        label = '%s.%s' % (self.rated_model._meta.app_label,
+                           self.rated_model._meta.object_name)
+        totals = stats.totals()
+        self.assertEqual(totals['rate', label]['calls'], 1)
+        self.assertEqual(totals['rate', label]['queries'], events[0][2])
+        self.assertEqual(totals['rate', label]['rows'], 1)
+        stats.reset()
+        self.assertEqual(stats.totals(), {})
+
+        # the filter is reported while rendering
+        del events[:]
+        t = Template('{% load ratings_tags %}{{ obj|rating_score:user }}')
+        c = Context({'obj': self.item1, 'user': self.jane})
+        self.assertEqual(t.render(c), '3.0')
+        self.assertEqual([(sender, operation)
+                          for sender, operation, q, r in events],
+                         [(self.rated_model, 'rating_score')])
+
     def test_rated_item_model_unicode(self):
         self.john.username = u'Иван'
         rating = self.item1.ratings.rate(self.john, 1)
         rating_unicode_string = unicode(rating)
 
+    def test_rate_many(self):
+        self.item1.ratings.rate(self.john, 1)
+        ratings = self.rated_model.ratings
+
+        received = []
+        def receiver(sender, instance, created, **kwargs):
+            received.append((instance.user.username, instance.score, created))
+        models.signals.post_save.connect(receiver, sender=self.rating_model)
+        self.addCleanup(models.signals.post_save.disconnect, receiver,
+                        sender=self.rating_model)
+
+        result = ratings.rate_many([(self.item1, self.john, 3),
+                                    (self.item1, self.jane, 4),
+                                    (self.item2, self.john, 2),
+                                    (self.item2, self.john, 5)])
+
+        # the last score of a user for an object wins
+        self.assertEqual(result, (2, 1))
+        self.assertEqual(self.item1.ratings.get(user=self.john).score, 3)
+        self.assertEqual(self.item1.ratings.get(user=self.jane).score, 4)
+        self.assertEqual(self.item2.ratings.get(user=self.john).score, 5)
+        self.assertEqual(ratings.count(), 3)
+        self.assertEqual(sorted(received), [('jane', 4, True),
+                                            ('john', 3, False),
+                                            ('john', 5, True)])
+
+        # unchanged scores are left alone, and signals can be skipped
+        del received[:]
+        result = ratings.rate_many([(self.item1, self.jane, 4),
+                                    (self.item2, self.jane, 1)],
+                                   send_signals=False)
+        self.assertEqual(result, (1, 0))
+        self.assertEqual(received, [])
+        self.assertEqual(self.item2.ratings.get(user=self.jane).score, 1)
+
+        self.assertRaises(TypeError, ratings.rate_many,
+                          [(self.john, self.jane, 1)])
+
+    def test_rate_many_large_batch(self):
+        # more objects in a batch than SQLite binds parameters in a query
+        for i in range(0, 1200, 100):
+            self.rated_model.objects.bulk_create([
+                self.rated_model(name='bulk%d' % j)
+                for j in range(i, i + 100)])
+        objects = list(self.rated_model.objects.filter(
+            name__startswith='bulk'))
+        ratings = self.rated_model.ratings
+
+        votes = [(obj, self.john, 3) for obj in objects]
+        self.assertEqual(ratings.rate_many(votes, batch_size=1200),
+                         (1200, 0))
+        votes = [(obj, self.john, 4) for obj in objects[:1000]] + [
+            (obj, self.jane, 2) for obj in objects[:1000]]
+        self.assertEqual(ratings.rate_many(votes, batch_size=2000),
+                         (1000, 1000))
+        self.assertEqual(ratings.filter(user=self.john, score=4).count(),
+                         1000)
+        self.assertEqual(ratings.count(), 2200)
+
 
 class CustomModelRatingsTestCase(RatingsTestCase):
     rated_model = Beverage
     rating_model = BeverageRating
 
 
+class AggregatedRatingsTestCase(RatingsTestCase):
+    rated_model = Snack
+
+    def assertTotalsMatch(self):
+        for item in (self.item1, self.item2):
+            self.assertEqual(item.ratings.cumulative_score(),
+                             item.ratings.perform_aggregation(models.Sum))
+            self.assertEqual(item.ratings.average_score(),
+                             item.ratings.perform_aggregation(models.Avg))
+
+    def test_aggregate_totals(self):
+        self.assertEqual(self.item1.ratings.cumulative_score(), None)
+        self.assertEqual(self.item1.ratings.variance(), None)
+
+        self.item1.ratings.rate(self.john, 2)
+        self.item1.ratings.rate(self.jane, 4)
+        self.item2.ratings.rate(self.john, -1)
+        self.assertTotalsMatch()
+
+        self.assertEqual(self.item1.ratings.variance(), 1.0)
+        self.assertEqual(self.item1.ratings.standard_deviation(), 1.0)
+
+        # re-rating only changes the score
+        self.item1.ratings.rate(self.jane, 6)
+        self.assertEqual(self.item1.ratings.get_aggregate().num_ratings, 2)
+        self.assertTotalsMatch()
+
+        # moving a rating from one object to another
+        self.item1.ratings.unrate(self.john)
+        rating = self.item2.ratings.get(user=self.john)
+        self.item1.ratings.add(rating)
+        self.assertEqual(self.item2.ratings.cumulative_score(), None)
+        self.assertEqual(self.item1.ratings.cumulative_score(), 5)
+        self.assertTotalsMatch()
+
+        self.item1.ratings.remove(rating)
+        self.item1.ratings.create(user=self.john, score=3)
+        self.assertTotalsMatch()
+
+        self.item1.ratings.upsert(self.john, 4)
+        self.assertTotalsMatch()
+
+        self.item1.ratings.unrate(self.jane)
+        self.assertEqual(self.item1.ratings.cumulative_score(), 4)
+        self.assertTotalsMatch()
+
+        self.item1.ratings.clear()
+        self.assertEqual(self.item1.ratings.cumulative_score(), None)
+        self.assertTotalsMatch()
+
+    def test_rate_many_totals(self):
+        self.item1.ratings.rate(self.john, 1)
+        self.rated_model.ratings.rate_many([(self.item1, self.john, 3),
+                                            (self.item1, self.jane, 4),
+                                            (self.item2, self.john, 2)])
+        self.assertEqual(self.item1.ratings.cumulative_score(), 7)
+        self.assertTotalsMatch()
+
+    def test_leaderboard_follows_writes(self):
+        ratings_models.UPDATE_LEADERBOARDS = True
+        self.addCleanup(setattr, ratings_models, 'UPDATE_LEADERBOARDS', False)
+        ratings = self.rated_model.ratings
+
+        self.item1.ratings.rate(self.john, 5)
+        self.item2.ratings.rate(self.john, 1)
+        ratings.update_leaderboard(size=1)
+        self.assertEqual(ratings.top_rated(n=1), [self.item1])
+
+        # item2 overtakes item1, which drops off the board
+        self.item2.ratings.rate(self.jane, 5)
+        top = ratings.top_rated()
+        self.assertEqual([(obj, obj.score) for obj in top],
+                         [(self.item2, 6), (self.item1, 5)])
+
+        # item2 falls back and leaves the board empty, which top_rated()
+        # backfills until the board is rebuilt
+        self.item2.ratings.unrate(self.jane)
+        top = ratings.top_rated()
+        self.assertEqual([(obj, obj.score) for obj in top],
+                         [(self.item1, 5), (self.item2, 1)])
+        self.assertEqual(ratings.top_rated(n=1), [self.item1])
+        ratings.update_leaderboard(size=1)
+        with self.assertNumQueries(2):
+            self.assertEqual(ratings.top_rated(n=1), [self.item1])
+        self.assertEqual(ratings.top_rated(), [self.item1, self.item2])
+
+    def test_rebuild_aggregates(self):
+        self.item1.ratings.rate(self.john, 2)
+        self.item1.ratings.rate(self.jane, 4)
+        self.item2.ratings.rate(self.john, -1)
+
+        aggregate_model = self.rated_model.ratings.aggregate_model
+        aggregate_model.objects.all().update(num_ratings=10, total_score=0)
+
+        self.rated_model.ratings.rebuild_aggregates()
+        self.assertEqual(aggregate_model.objects.count(), 2)
+        self.assertTotalsMatch()
+        self.assertEqual(self.item1.ratings.variance(), 1.0)
+
+
+class CustomModelAggregatedRatingsTestCase(AggregatedRatingsTestCase):
+    rated_model = Juice
+    rating_model = JuiceRating
+
+
+class BatchRatingTransactionTestCase(TransactionTestCase):
+    # TestCase turns transactions off on Django < 1.6, rollbacks need a
+    # TransactionTestCase to be seen
+    def setUp(self):
+        self.user = User.objects.create_user('a', 'a', 'a')
+        self.food1 = Food.objects.create(name='apple')
+        self.food2 = Food.objects.create(name='orange')
+
+    def test_batch_rolls_back(self):
+        self.food1.ratings.rate(self.user, 3)
+        self.client.login(username='a', password='a')
+        ctype = ContentType.objects.get_for_model(Food)
+
+        def receiver(sender, instance, **kwargs):
+            if instance.object_id == self.food2.pk:
+                raise ValueError('Rating refused')
+        models.signals.post_save.connect(receiver, sender=RatedItem)
+        self.addCleanup(models.signals.post_save.disconnect, receiver,
+                        sender=RatedItem)
+
+        # the unrating of food1 is undone with the failed rating of food2
+        self.assertRaises(ValueError, self.client.post,
+                          reverse('ratings_rate_objects'), json.dumps([
+                              {'ct': ctype.pk, 'pk': self.food1.pk,
+                               'score': None},
+                              {'ct': ctype.pk, 'pk': self.food2.pk,
+                               'score': 4}]),
+                          content_type='application/json')
+        self.assertEqual(self.food1.ratings.get(user=self.user).score, 3)
+        self.assertEqual(self.food2.ratings.count(), 0)
+
+    def test_nested_block_rolls_back(self):
+        # a failed nested block leaves the outer transaction usable, which
+        # the retries on IntegrityError depend on
+        with ratings_utils.atomic():
+            self.food1.ratings.rate(self.user, 3)
+            try:
+                with ratings_utils.atomic():
+                    Food.objects.create(pk=self.food2.pk, name='duplicate')
+            except IntegrityError:
+                pass
+            self.food2.ratings.rate(self.user, 4)
+        self.assertEqual(RatedItem.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(Food.objects.get(pk=self.food2.pk).name, 'orange')
+
+
+class ParallelSimilarItemsTestCase(TransactionTestCase):
+    # the workers only run outside of a transaction, which TestCase always
+    # opens
+    def setUp(self):
+        users = [User.objects.create_user('user%d' % i, 'user%d' % i)
+                 for i in range(4)]
+        self.foods = [Food.objects.create(name='food%d' % i)
+                      for i in range(4)]
+        for i, user in enumerate(users):
+            for j, food in enumerate(self.foods):
+                food.ratings.rate(user, (i * j) % 5 + 1)
+
+    def similar_items(self, workers):
+        SimilarItem.objects.all().delete()
+        calculate_similar_items(RatedItem.objects.all(), 3, workers=workers)
+        return sorted(SimilarItem.objects.values_list(
+            'object_id', 'similar_object_id', 'score'))
+
+    def assertSameItems(self, results, expected):
+        self.assertEqual([r[:2] for r in results], [r[:2] for r in expected])
+        for res, exp in zip(results, expected):
+            self.assertAlmostEqual(res[2], exp[2])
+
+    def test_workers(self):
+        from django.db import connection
+        if 'memory' in (connection.settings_dict['NAME'] or ':memory:'):
+            self.skipTest('Workers cannot open an in-memory database')
+
+        # every worker scores its share over a connection of its own, and
+        # this process opens a new one once they are done
+        serial = self.similar_items(1)
+        self.assertTrue(serial)
+        self.assertSameItems(self.similar_items(2), serial)
+        self.assertEqual(RatedItem.objects.count(), 16)
+
+    def test_workers_in_transaction(self):
+        user = User.objects.create_user('a', 'a')
+
+        # closing the connection for the workers would lose the rating, so
+        # the items are scored in this process
+        with ratings_utils.atomic():
+            self.foods[0].ratings.rate(user, 5)
+            self.assertTrue(self.similar_items(2))
+        self.assertEqual(self.foods[0].ratings.filter(user=user).count(), 1)
+
+
 class RecommendationsTestCase(TestCase):
     fixtures = ['ratings_testdata.json']
 
@@ -648,6 +1316,20 @@ class RecommendationsTestCase(TestCase):
         result = sim_pearson_correlation(RatedItem.objects.all(), self.user_a, self.user_b)
         self.assertEqual(str(result)[:5], '0.396')
 
+    def test_similarity_filtered_queryset(self):
+        # filter parameters are bound rather than pasted into the statement
+        ratings = RatedItem.objects.exclude(hashed="it's")
+
+        result = sim_euclidean_distance(ratings, self.user_a, self.user_b)
+        self.assertEqual(str(result)[:5], '0.148')
+
+        result = sim_pearson_correlation(ratings, self.user_a, self.user_b)
+        self.assertEqual(str(result)[:5], '0.396')
+
+        ratings = RatedItem.objects.filter(user__in=[self.user_a, self.user_b])
+        result = sim_pearson_correlation(ratings, self.food_a, self.food_b)
+        self.assertEqual(result, 0)
+
     def test_matching(self):
         results = top_matches(RatedItem.objects.all(), self.users,
                               self.user_g, 3)
@@ -658,6 +1340,25 @@ class RecommendationsTestCase(TestCase):
             self.assertEqual(res[1], exp[1])
             self.assertAlmostEqual(res[0], exp[0])
 
+    def test_similarity_many(self):
+        ratings = RatedItem.objects.all()
+        for many, similarity in ((sim_pearson_many, sim_pearson_correlation),
+                                 (sim_euclidean_many, sim_euclidean_distance)):
+            results = many(ratings, self.user_g, self.users)
+            self.assertEqual(len(results), 6)
+            for score, other in results:
+                self.assertAlmostEqual(
+                    score, similarity(ratings, self.user_g, other))
+
+        # items nobody co-rated are not matched at all
+        food_g = Food.objects.create(name='food_g')
+        user_h = User.objects.create_user('user_h', 'user_h')
+        food_g.ratings.rate(user_h, 3)
+
+        results = top_matches(ratings, self.foods + [food_g], self.food_a, 10)
+        self.assertEqual(len(results), 5)
+        self.assertFalse(food_g in [other for score, other in results])
+
     def test_recommending(self):
         results = recommendations(RatedItem.objects.all(), self.users, self.user_g)
         expected = [(3.3477895267131017, self.food_f), (2.8325499182641614, self.food_a), (2.5309807037655649, self.food_c)]
@@ -665,6 +1366,36 @@ class RecommendationsTestCase(TestCase):
             self.assertEqual(res[1], exp[1])
             self.assertAlmostEqual(res[0], exp[0])
 
+    def test_recommending_neighbourhood(self):
+        # similarities, the neighbours' ratings and the recommended foods
+        with self.assertNumQueries(3):
+            results = recommendations(RatedItem.objects.all(), self.users,
+                                      self.user_g, n=1)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][1], self.food_f)
+        self.assertAlmostEqual(results[0][0], 3.3477895267131017)
+
+        # only the most similar user, user_a, is consulted
+        results = recommendations(RatedItem.objects.all(), self.users,
+                                  self.user_g, k=1)
+        self.assertEqual(sorted([(score, food.pk) for score, food in results]),
+                         [(2.5, self.food_a.pk), (3.0, self.food_c.pk),
+                          (3.0, self.food_f.pk)])
+
+        # people given as a queryset are matched in chunks, not loaded whole,
+        # and raters outside of it are not consulted
+        user_h = User.objects.create_user('user_h', 'user_h')
+        for food, score in ((self.food_b, 4.5), (self.food_d, 4.0),
+                            (self.food_e, 1.0), (self.food_a, 1.0)):
+            food.ratings.rate(user_h, score)
+        people = User.objects.exclude(pk=user_h.pk)
+        for k in (None, 1):
+            self.assertEqual(
+                recommendations(RatedItem.objects.all(), people, self.user_g,
+                                k=k),
+                recommendations(RatedItem.objects.all(), self.users,
+                                self.user_g, k=k))
+
     def test_item_recommendation(self):
         results = top_matches(RatedItem.objects.all(), self.foods, self.food_d)
         expected = [(0.65795169495976946, self.food_e), (0.48795003647426888, self.food_a), (0.11180339887498941, self.food_b), (-0.17984719479905439, self.food_f), (-0.42289003161103106, self.food_c)]
@@ -688,6 +1419,205 @@ class RecommendationsTestCase(TestCase):
         other_for_food_a = self.food_a.ratings.similar_items()[0]
         self.assertEqual(top_for_food_a, other_for_food_a)
 
+    def test_ratings_matrix(self):
+        matrix = ratings_utils.RatingsMatrix(RatedItem.objects.all())
+
+        for similarity in (sim_pearson_correlation, sim_euclidean_distance):
+            for food in self.foods:
+                hashed = RatedItem(content_object=food).generate_hash()
+                scores = matrix.item_similarities(hashed, similarity=similarity)
+                for other in self.foods:
+                    if other == food:
+                        continue
+                    other_hashed = RatedItem(content_object=other).generate_hash()
+                    self.assertAlmostEqual(
+                        scores[other_hashed],
+                        similarity(RatedItem.objects.all(), food, other))
+
+            scores = matrix.user_similarities(self.user_a.pk, similarity=similarity)
+            self.assertAlmostEqual(
+                scores[self.user_b.pk],
+                similarity(RatedItem.objects.all(), self.user_a, self.user_b))
+
+    def test_similar_items_in_memory(self):
+        calculate_similar_items(RatedItem.objects.all(), 10)
+        expected = [(si.similar_object, si.score)
+                    for si in self.food_a.ratings.similar_items()]
+
+        SimilarItem.objects.all().delete()
+        calculate_similar_items(RatedItem.objects.all(), 10, engine='memory')
+        results = [(si.similar_object, si.score)
+                   for si in self.food_a.ratings.similar_items()]
+
+        self.assertEqual(len(results), len(expected))
+        for res, exp in zip(results, expected):
+            self.assertEqual(res[0], exp[0])
+            self.assertAlmostEqual(res[1], exp[1])
+
+        self.assertRaises(ValueError, calculate_similar_items,
+                          RatedItem.objects.all(), 10, engine='unknown')
+
+    def test_snapshot(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        Food.ratings.export_snapshot(path)
+        snapshot = RatingsSnapshot(path)
+        self.addCleanup(snapshot.close)
+
+        self.assertEqual(snapshot.rating_model, RatedItem)
+        self.assertEqual(snapshot.rated_model, Food)
+        self.assertEqual(snapshot.num_ratings, Food.ratings.count())
+
+        # the mapped scores match the ones loaded from the database
+        matrix = ratings_utils.RatingsMatrix(Food.ratings.all())
+        self.assertEqual(sorted(snapshot.items), sorted(matrix.items))
+        for hashed, vector in matrix.items.iteritems():
+            self.assertEqual(snapshot.items[hashed], vector)
+        for user_id, vector in matrix.users.iteritems():
+            self.assertEqual(snapshot.users[user_id], vector)
+
+        calculate_similar_items(Food.ratings.all(), 10, engine='memory')
+        expected = [(si.similar_object, si.score)
+                    for si in self.food_a.ratings.similar_items()]
+
+        SimilarItem.objects.all().delete()
+        calculate_similar_items(Food.ratings.all(), 10, engine='memory',
+                                snapshot=snapshot)
+        results = [(si.similar_object, si.score)
+                   for si in self.food_a.ratings.similar_items()]
+
+        self.assertEqual(len(results), len(expected))
+        for res, exp in zip(results, expected):
+            self.assertEqual(res[0], exp[0])
+            self.assertAlmostEqual(res[1], exp[1])
+
+        self.assertRaises(ValueError, calculate_similar_items,
+                          Food.ratings.all(), 10, snapshot=snapshot)
+
+    def test_item_key(self):
+        ctype = ContentType.objects.get_for_model(Food)
+        rating = RatedItem.objects.filter(object_id=self.food_a.pk)[0]
+        self.assertEqual(rating.item_key, (ctype.pk << 32) + self.food_a.pk)
+        self.assertFalse(RatedItem.objects.filter(item_key=None).exists())
+
+        calculate_similar_items(RatedItem.objects.all(), 10)
+        expected = [(si.similar_object, si.score)
+                    for si in self.food_a.ratings.similar_items()]
+        recommended = recommended_items(RatedItem.objects.all(), self.user_g)
+
+        self.addCleanup(setattr, ratings_utils, 'ITEM_KEY',
+                        ratings_utils.ITEM_KEY)
+        ratings_utils.ITEM_KEY = 'item_key'
+
+        for engine in ('sql', 'memory'):
+            SimilarItem.objects.all().delete()
+            calculate_similar_items(RatedItem.objects.all(), 10, engine=engine)
+            results = [(si.similar_object, si.score)
+                       for si in self.food_a.ratings.similar_items()]
+
+            self.assertEqual(len(results), len(expected))
+            for res, exp in zip(results, expected):
+                self.assertEqual(res[0], exp[0])
+                self.assertAlmostEqual(res[1], exp[1])
+
+        results = recommended_items(RatedItem.objects.all(), self.user_g)
+        self.assertEqual([r[1] for r in results], [r[1] for r in recommended])
+        for res, exp in zip(results, recommended):
+            self.assertAlmostEqual(res[0], exp[0])
+
+    def test_similar_items_lsh(self):
+        ratings = RatedItem.objects.all()
+        calculate_similar_items(ratings, 10, engine='lsh', bands=64)
+
+        # whatever is found is scored exactly
+        self.assertTrue(SimilarItem.objects.count() > 0)
+        for si in SimilarItem.objects.all():
+            self.assertAlmostEqual(
+                si.score,
+                sim_pearson_correlation(ratings, si.content_object,
+                                        si.similar_object))
+
+        # more bands only ever find more neighbours
+        low = ratings_utils.lsh_recall(ratings, bands=1)
+        high = ratings_utils.lsh_recall(ratings, bands=64)
+        self.assertTrue(0 <= low <= high <= 1)
+
+    def test_similar_items_stale_neighbours(self):
+        ctype = ContentType.objects.get_for_model(Food)
+        SimilarItem.objects.create(content_type=ctype,
+                                   object_id=self.food_a.pk,
+                                   similar_content_type=ctype,
+                                   similar_object_id=self.food_a.pk,
+                                   score=100)
+
+        calculate_similar_items(RatedItem.objects.all(), 10)
+        similar = self.food_a.ratings.similar_items()
+        self.assertEqual(len(similar), 5)
+        self.assertFalse(self.food_a in [si.similar_object for si in similar])
+
+        # shrinking the neighbourhood removes the neighbours that fell off
+        calculate_similar_items(RatedItem.objects.all(), 2)
+        self.assertEqual(self.food_a.ratings.similar_items().count(), 2)
+        self.assertEqual(SimilarItem.objects.count(), 12)
+
+        # unchanged neighbours are not rewritten
+        pks = list(SimilarItem.objects.values_list('pk', flat=True))
+        calculate_similar_items(RatedItem.objects.all(), 2)
+        self.assertEqual(
+            sorted(SimilarItem.objects.values_list('pk', flat=True)),
+            sorted(pks))
+
+    @skipUnlessDB('sqlite')
+    def test_similar_items_in_parallel(self):
+        fields = ('object_id', 'similar_object_id', 'score')
+
+        def similar_items(engine, workers):
+            SimilarItem.objects.all().delete()
+            calculate_similar_items(RatedItem.objects.all(), 3, engine=engine,
+                                    workers=workers)
+            return sorted(SimilarItem.objects.values_list(*fields))
+
+        def assertSameItems(results, expected):
+            self.assertEqual([r[:2] for r in results],
+                             [r[:2] for r in expected])
+            for res, exp in zip(results, expected):
+                self.assertAlmostEqual(res[2], exp[2])
+
+        # the exact engines find the same items as the serial sql engine
+        serial = similar_items('sql', 1)
+        for engine in ('sql', 'memory'):
+            assertSameItems(similar_items(engine, 2), serial)
+
+        # lsh is approximate, but its hyperplanes are seeded, so splitting
+        # the work does not change what it finds
+        assertSameItems(similar_items('lsh', 2), similar_items('lsh', 1))
+
+    def test_incremental_similar_items(self):
+        calculate_similar_items(RatedItem.objects.all(), 10)
+
+        ratings_models.TRACK_DIRTY_ITEMS = True
+        try:
+            self.food_a.ratings.rate(self.user_g, 5)
+            self.food_c.ratings.unrate(self.user_a)
+            self.assertEqual(
+                sorted(DirtyItem.objects.values_list('object_id', flat=True)),
+                [self.food_a.pk, self.food_c.pk])
+
+            calculate_similar_items(RatedItem.objects.all(), 10,
+                                    incremental=True)
+            self.assertEqual(DirtyItem.objects.count(), 0)
+        finally:
+            ratings_models.TRACK_DIRTY_ITEMS = False
+
+        fields = ('object_id', 'similar_object_id', 'score')
+        incremental = sorted(SimilarItem.objects.values_list(*fields))
+
+        calculate_similar_items(RatedItem.objects.all(), 10)
+        self.assertEqual(sorted(SimilarItem.objects.values_list(*fields)),
+                         incremental)
+
     def test_recommended_items(self):
         calculate_similar_items(RatedItem.objects.all())
         # failure
@@ -711,6 +1641,50 @@ class RecommendationsTestCase(TestCase):
         self.assertEqual(str(r2[0])[:5], '2.084')
         self.assertEqual(r2[1], self.food_e)
 
+        # the user's ratings, their neighbours and the recommended foods
+        with self.assertNumQueries(3):
+            result = recommended_items(RatedItem.objects.all(), self.user_g, 2)
+        self.assertEqual([r[1] for r in result], [self.food_a, self.food_f])
+
+    def test_cached_results(self):
+        calculate_similar_items(RatedItem.objects.all())
+
+        ratings_cache.CACHE_ALIAS = 'default'
+        try:
+            expected = Food.ratings.recommended_items(self.user_g)
+            similar = list(self.food_a.ratings.similar_items())
+            with self.assertNumQueries(0):
+                self.assertEqual(Food.ratings.recommended_items(self.user_g),
+                                 expected)
+                cached = Food.ratings.similar_items(self.food_a)
+                self.assertEqual(list(cached), similar)
+
+            # the same type is returned with and without a cache
+            self.assertTrue(isinstance(cached, QuerySet))
+            self.assertEqual(list(cached.filter(score__gt=0)),
+                             [item for item in similar if item.score > 0])
+
+            # rating something drops the user's recommendations
+            self.food_c.ratings.rate(self.user_g, 1)
+            result = Food.ratings.recommended_items(self.user_g)
+            self.assertFalse(self.food_c in [obj for score, obj in result])
+
+            # and the similar items cached for the rated item
+            with self.assertNumQueries(1):
+                list(self.food_c.ratings.similar_items())
+            with self.assertNumQueries(0):
+                list(self.food_c.ratings.similar_items())
+            self.food_c.ratings.rate(self.user_a, 5)
+            with self.assertNumQueries(1):
+                list(self.food_c.ratings.similar_items())
+
+            # recalculating drops every cached result
+            calculate_similar_items(RatedItem.objects.all(), 1)
+            self.assertEqual(len(self.food_a.ratings.similar_items()), 1)
+        finally:
+            ratings_cache.get_backend().clear()
+            ratings_cache.CACHE_ALIAS = None
+
     def test_similar_item_model_unicode(self):
         self.food_b.name = u'яблоко'
         self.food_b.save()
@@ -0,0 +1,188 @@
+import json
+import mmap
+import struct
+import sys
+from array import array
+from itertools import izip
+
+from django.db.models import get_model
+
+from ratings import utils as ratings_utils
+from ratings.utils import content_keys
+
+
+# a snapshot file holds, in little-endian byte order:
+#
+#   MAGIC
+#   uint32 length of the JSON header, and the header itself, padded to a
+#   multiple of four bytes.  The header names the rating and rated models
+#   and the column items are keyed by, and maps the user and item indexes
+#   used below to user ids and to (item key, content type id, object id)
+#   triples
+#   the ratings twice in compressed sparse row form, first with a row per
+#   item, then with a row per user.  Each copy is an int32 array of row
+#   offsets, an int32 array of column indexes and a float32 array of scores
+MAGIC = 'RATINGS1'
+
+
+def write_snapshot(ratings_queryset, path):
+    """
+    Writes the ratings in the queryset to a snapshot file at path
+    """
+    users = {}
+    items = {}
+    item_keys = []
+    rows = array('i')
+    columns = array('i')
+    scores = array('f')
+
+    item_key = ratings_utils.ITEM_KEY
+    for key, item, user_id, score in content_keys(ratings_queryset, item_key,
+                                                  'user', 'score'):
+        if item not in items:
+            items[item] = len(item_keys)
+            item_keys.append((item,) + key)
+        if user_id not in users:
+            users[user_id] = len(users)
+        rows.append(items[item])
+        columns.append(users[user_id])
+        scores.append(score)
+
+    user_ids = sorted(users, key=users.get)
+    rated_model = getattr(ratings_queryset, 'rated_model', None)
+    header = json.dumps({
+        'rating_model': _model_label(ratings_queryset.model),
+        'rated_model': rated_model and _model_label(rated_model),
+        'item_key': item_key,
+        'users': user_ids,
+        'items': item_keys,
+        'num_ratings': len(scores),
+    })
+    header += ' ' * (-len(header) % 4)
+
+    with open(path, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(struct.pack('<I', len(header)))
+        fh.write(header)
+        for arrays in (_compress(rows, columns, scores, len(item_keys)),
+                       _compress(columns, rows, scores, len(user_ids))):
+            for values in arrays:
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                values.tofile(fh)
+
+
+def _model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def _compress(rows, columns, scores, num_rows):
+    # sort the (row, column, score) triples by row with a counting sort,
+    # returning the row offsets and the sorted columns and scores
+    indptr = array('i', [0] * (num_rows + 1))
+    for row in rows:
+        indptr[row + 1] += 1
+    for i in range(num_rows):
+        indptr[i + 1] += indptr[i]
+
+    position = array('i', indptr)
+    sorted_columns = array('i', [0] * len(columns))
+    sorted_scores = array('f', [0] * len(scores))
+    for row, column, score in izip(rows, columns, scores):
+        sorted_columns[position[row]] = column
+        sorted_scores[position[row]] = score
+        position[row] += 1
+    return indptr, sorted_columns, sorted_scores
+
+
+class CompressedRows(object):
+    """
+    A read-only mapping of row key -> {column key: score} over one copy of
+    the ratings in a snapshot.  Rows are decoded from the mapped file on
+    access, so processes sharing the file share a single copy of the scores.
+    """
+    def __init__(self, buf, offset, row_keys, column_keys, num_ratings):
+        self.buf = buf
+        self.row_keys = row_keys
+        self.column_keys = column_keys
+        self.row_index = dict((key, i) for i, key in enumerate(row_keys))
+
+        self.indptr_offset = offset
+        self.columns_offset = offset + 4 * (len(row_keys) + 1)
+        self.scores_offset = self.columns_offset + 4 * num_ratings
+        self.end = self.scores_offset + 4 * num_ratings
+
+    def __getitem__(self, key):
+        i = self.row_index[key]
+        start, end = struct.unpack_from('<2i', self.buf,
+                                        self.indptr_offset + 4 * i)
+        size = end - start
+        columns = struct.unpack_from('<%di' % size, self.buf,
+                                     self.columns_offset + 4 * start)
+        scores = struct.unpack_from('<%df' % size, self.buf,
+                                    self.scores_offset + 4 * start)
+        column_keys = self.column_keys
+        return dict((column_keys[column], score)
+                    for column, score in izip(columns, scores))
+
+    def get(self, key, default=None):
+        if key not in self.row_index:
+            return default
+        return self[key]
+
+    def __contains__(self, key):
+        return key in self.row_index
+
+    def __iter__(self):
+        return iter(self.row_keys)
+
+    def __len__(self):
+        return len(self.row_keys)
+
+    def iteritems(self):
+        for key in self.row_keys:
+            yield key, self[key]
+
+
+class RatingsSnapshot(object):
+    """
+    A snapshot file opened with mmap.  ``items`` maps item keys and
+    ``users`` maps user ids to their ratings, like a RatingsMatrix, which
+    accepts a snapshot in place of a ratings queryset.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self.buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.buf[:len(MAGIC)] != MAGIC:
+            raise ValueError('%s is not a ratings snapshot' % path)
+
+        offset = len(MAGIC)
+        header_length, = struct.unpack_from('<I', self.buf, offset)
+        offset += 4
+        header = json.loads(self.buf[offset:offset + header_length])
+        offset += header_length
+
+        item_key = header.get('item_key', 'hashed')
+        if item_key != ratings_utils.ITEM_KEY:
+            self.buf.close()
+            raise ValueError('%s keys items by %s, not by %s' % (
+                path, item_key, ratings_utils.ITEM_KEY))
+
+        self.rating_model = get_model(*header['rating_model'].split('.'))
+        self.rated_model = None
+        if header['rated_model']:
+            self.rated_model = get_model(*header['rated_model'].split('.'))
+        self.user_ids = header['users']
+        self.item_keys = [tuple(key) for key in header['items']]
+        self.num_ratings = header['num_ratings']
+
+        keys = [key[0] for key in self.item_keys]
+        self.items = CompressedRows(self.buf, offset, keys, self.user_ids,
+                                    self.num_ratings)
+        self.users = CompressedRows(self.buf, self.items.end, self.user_ids,
+                                    keys, self.num_ratings)
+
+    def close(self):
+        self.buf.close()
@@ -2,6 +2,8 @@ from django import template
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 
+from ratings.instrumentation import instrumented
+
 register = template.Library()
 
 
@@ -10,9 +12,20 @@ def rating_score(obj, user):
     """
     Returns the score a user has given an object
     """
+    # the filter itself keeps its signature, which the template engine
+    # checks the arguments against
+    return _rating_score(obj, user)
+
+
+@instrumented('rating_score')
+def _rating_score(obj, user):
     if not user.is_authenticated() or not hasattr(obj, '_ratings_field'):
         return False
 
+    cache = getattr(obj, '_rating_scores_cache', None)
+    if cache is not None and user.pk in cache:
+        return cache[user.pk]
+
     ratings_descriptor = getattr(obj, obj._ratings_field)
     try:
         rating = ratings_descriptor.get(user=user).score
@@ -30,6 +43,26 @@ def has_rated(user, obj):
     return rating_score(obj, user) is not None
 
 
+@register.simple_tag
+def prefetch_user_scores(objects, user):
+    """
+    Loads the scores a user has given to a list of objects with one query per
+    rated model, so that ``rating_score`` and ``has_rated`` do not query once
+    per object
+    """
+    if not user.is_authenticated():
+        return ''
+
+    by_model = {}
+    for obj in objects:
+        if hasattr(obj, '_ratings_field'):
+            by_model.setdefault(type(obj), []).append(obj)
+
+    for model, objs in by_model.iteritems():
+        getattr(model, model._ratings_field).prefetch_user_scores(objs, user)
+    return ''
+
+
 @register.filter
 def rate_url(obj, score=1):
     """
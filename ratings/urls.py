@@ -7,5 +7,6 @@ except ImportError:  # pragma: no cover
 
 urlpatterns = patterns('ratings.views',
     url(r'^rate/(?P<ct>\d+)/(?P<pk>[^\/]+)/(?P<score>\-?[\d\.]+)/$', 'rate_object', name='ratings_rate_object'),
+    url(r'^rate/$', 'rate_objects', name='ratings_rate_objects'),
     url(r'^unrate/(?P<ct>\d+)/(?P<pk>[^\/]+)/$', 'rate_object', {'add': False}, name='ratings_unrate_object'),
 )
@@ -1,18 +1,48 @@
+import heapq
+import itertools
+import multiprocessing
+import os
+import random
+import weakref
+from contextlib import contextmanager
 from math import sqrt
+from operator import itemgetter
 
 import django
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.generic import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection
+from django.db import connection, connections, models, router, transaction
+from django.utils import timezone
+
+from ratings import cache as ratings_cache
+from ratings.instrumentation import instrumented
+
+
+# the column similarity and recommendation queries identify rated items by,
+# the 40 character 'hashed' or the 64-bit integer 'item_key'
+ITEM_KEY = getattr(settings, 'RATINGS_ITEM_KEY', 'hashed')
+
+
+# rating model options -> content_object field
+_content_fields = {}
 
 
 def get_content_object_field(rating_model):
     opts = rating_model._meta
+    try:
+        return _content_fields[opts]
+    except KeyError:
+        pass
     for virtual_field in opts.virtual_fields:
         if virtual_field.name == 'content_object':
-            return virtual_field  # break out early
-    return opts.get_field('content_object')
+            field = virtual_field  # break out early
+            break
+    else:
+        field = opts.get_field('content_object')
+    _content_fields[opts] = field
+    return field
 
 
 def is_gfk(content_field):
@@ -39,19 +69,352 @@ def query_as_sql(query):
         return query.get_compiler(connection=connection).as_sql()
 
 
-def sim_euclidean_distance(ratings_queryset, factor_a, factor_b):
+@contextmanager
+def _savepoint(using=None):
+    sid = transaction.savepoint(using=using)
+    try:
+        yield
+    except Exception:
+        transaction.savepoint_rollback(sid, using=using)
+        raise
+    transaction.savepoint_commit(sid, using=using)
+
+
+def atomic(using=None):
+    """
+    Returns a context manager running its block in a single transaction.
+    Blocks nested in a transaction run in a savepoint of it, which is rolled
+    back if they fail, and only the outermost one commits.
+    """
+    if django.VERSION < (1, 6):
+        if transaction.is_managed(using=using):
+            # commit_on_success would commit the outer transaction too early
+            return _savepoint(using)
+        return transaction.commit_on_success(using=using)
+    return transaction.atomic(using=using)
+
+
+def in_transaction(using=None):
+    """
+    Returns whether a transaction block is open on the connection, whose
+    uncommitted work would be lost if the connection were closed
+    """
+    if django.VERSION < (1, 6):
+        return transaction.is_managed(using=using)
+    return transaction.get_connection(using).in_atomic_block
+
+
+def chunked(iterable, size):
+    """
+    Yields successive lists of at most ``size`` elements from ``iterable``
+    """
+    chunk = []
+    for obj in iterable:
+        chunk.append(obj)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def upsert_row(obj, unique_fields, update_fields):
+    """
+    Inserts obj, or updates the update_fields of the row it clashes with on
+    unique_fields, in a single statement.  Returns False without touching the
+    database when the backend has no such statement.
+    """
+    model = obj.__class__
+    using = router.db_for_write(model, instance=obj)
+    conn = connections[using]
+
+    if conn.vendor == 'postgresql':
+        supported = getattr(conn, 'pg_version', 0) >= 90500
+    elif conn.vendor == 'sqlite':
+        # the library the connection was made with, which need not be the
+        # one of the sqlite3 module
+        from django.db.backends.sqlite3.base import Database
+        supported = Database.sqlite_version_info >= (3, 24)
+    else:
+        supported = conn.vendor == 'mysql'
+    if not supported:
+        return False
+
+    opts = model._meta
+    qn = conn.ops.quote_name
+    fields = [f for f in opts.local_fields
+              if not isinstance(f, models.AutoField)]
+    params = [f.get_db_prep_save(f.pre_save(obj, True), connection=conn)
+              for f in fields]
+    update_columns = [qn(opts.get_field(name).column)
+                      for name in update_fields]
+
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(opts.db_table),
+        ', '.join(qn(f.column) for f in fields),
+        ', '.join(['%s'] * len(fields)))
+    if conn.vendor == 'mysql':
+        sql += ' ON DUPLICATE KEY UPDATE %s' % ', '.join(
+            '%s = VALUES(%s)' % (column, column) for column in update_columns)
+    else:
+        sql += ' ON CONFLICT (%s) DO UPDATE SET %s' % (
+            ', '.join(qn(opts.get_field(name).column)
+                      for name in unique_fields),
+            ', '.join('%s = excluded.%s' % (column, column)
+                      for column in update_columns))
+
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    if django.VERSION < (1, 6):
+        transaction.commit_unless_managed(using=using)
+    return True
+
+
+def has_save_receivers(model):
+    """
+    Returns whether receivers of the pre_save or post_save signals of model
+    are connected, which upsert_row() does not send
+    """
+    for signal in (models.signals.pre_save, models.signals.post_save):
+        if hasattr(signal, 'has_listeners'):
+            if signal.has_listeners(model):
+                return True
+        else:
+            from django.dispatch.dispatcher import _make_id
+            if signal._live_receivers(_make_id(model)):
+                return True
+    return False
+
+
+def total_seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+# how the age in seconds of the rating aliased r1 is computed, given the
+# current time as a parameter
+AGE_SQL = {
+    'postgresql': 'EXTRACT(EPOCH FROM (%%s - r1.%(updated)s))',
+    'mysql': 'TIMESTAMPDIFF(SECOND, r1.%(updated)s, %%s)',
+    'sqlite': '((julianday(%%s) - julianday(r1.%(updated)s)) * 86400)',
+}
+
+
+class Ranker(object):
+    """
+    A ranking over the scores of each object's ratings which
+    order_by_rating() computes in the database.  Pass an instance as the
+    aggregator.
+    """
+    name = None
+
+    def as_sql(self, score):
+        """
+        Returns the aggregate SQL expression over the score column
+        """
+        raise NotImplementedError
+
+
+class BayesianAverage(Ranker):
+    """
+    The average score, pulled towards ``prior`` as if every object had also
+    received ``weight`` ratings of that score.  Objects with few ratings rank
+    near the prior instead of at the extremes.
+    """
+    name = 'bayesian'
+
+    def __init__(self, prior=3.0, weight=10):
+        if weight <= 0:
+            raise ValueError('The weight of the prior must be positive')
+        self.prior = float(prior)
+        self.weight = float(weight)
+
+    def as_sql(self, score):
+        return '((%r + COALESCE(SUM(%s), 0)) / (%r + COUNT(%s)))' % (
+            self.prior * self.weight, score, self.weight, score)
+
+
+class WilsonScore(Ranker):
+    """
+    The lower bound of the Wilson score interval of the share of positive
+    ratings, for +1/-1 ratings.  ``z`` sets the confidence, 1.96 being 95%.
+    """
+    name = 'wilson'
+
+    def __init__(self, z=1.96):
+        self.z = float(z)
+
+    def as_sql(self, score):
+        n = 'COUNT(%s)' % score
+        p = '(1.0 * SUM(CASE WHEN %s > 0 THEN 1 ELSE 0 END) / %s)' % (score, n)
+        z2 = self.z * self.z
+        return ('CASE WHEN %(n)s = 0 THEN NULL ELSE '
+                '(%(p)s + %(z2)r / (2 * %(n)s) - %(z)r * SQRT('
+                '(%(p)s * (1 - %(p)s) + %(z2)r / (4 * %(n)s)) / %(n)s)) / '
+                '(1 + %(z2)r / %(n)s) END') % {
+                    'n': n, 'p': p, 'z': self.z, 'z2': z2}
+
+
+def score_subquery_sql(ratings_queryset, rated_model, aggregator,
+                       half_life=None, window=None):
+    """
+    Returns the SQL and parameters of a subquery aggregating the scores of
+    each row of rated_model with aggregator, a Django aggregate or a Ranker,
+    for use in an extra select.  Scores can be decayed exponentially by their
+    age, halving every half_life, and limited to the ratings updated within
+    window; both are timedeltas.  Only Sum, Avg and Count can be decayed.
+    """
+    if isinstance(aggregator, Ranker):
+        function = None
+        if half_life is not None:
+            raise ValueError('Cannot decay ratings by %s' % aggregator.name)
+    else:
+        function = aggregator.name.upper()
+        if function not in ('SUM', 'AVG', 'COUNT', 'MAX', 'MIN'):
+            raise ValueError('Cannot rank ratings by %s in a subquery' %
+                             aggregator.name)
+        if half_life is not None and function not in ('SUM', 'AVG', 'COUNT'):
+            raise ValueError('Cannot decay ratings by %s' % aggregator.name)
+
     rating_model = ratings_queryset.model
+    opts = rating_model._meta
+    qn = connection.ops.quote_name
+    now = timezone.now()
+    column = lambda name: 'r1.%s' % qn(opts.get_field(name).column)
+    rated_pk = '%s.%s' % (qn(rated_model._meta.db_table),
+                          qn(rated_model._meta.pk.column))
+
+    field = get_content_object_field(rating_model)
+    params = []
+    if is_gfk(field):
+        where = '%s = %%s AND %s = %s' % (column(field.ct_field),
+                                          column(field.fk_field), rated_pk)
+        params.append(ContentType.objects.get_for_model(rated_model).pk)
+    else:
+        where = '%s = %s' % (column(field.name), rated_pk)
+
+    if window is not None:
+        where += ' AND %s >= %%s' % column('updated')
+        params.append(connection.ops.value_to_db_datetime(now - window))
+
+    queryset_filter, filter_params = get_queryset_filter(ratings_queryset)
+    where += queryset_filter
+    params.extend(filter_params)
+
+    select_params = []
+    score = column('score')
+    if function is None:
+        value = aggregator.as_sql(score)
+    elif half_life is None:
+        value = '%s(%s)' % (function, score)
+    else:
+        age = AGE_SQL[connection.vendor] % {
+            'updated': qn(opts.get_field('updated').column)}
+        weight = 'POWER(0.5, %s / %%s)' % age
+        if function == 'SUM':
+            value = 'SUM(%s * %s)' % (score, weight)
+        elif function == 'COUNT':
+            value = 'SUM(%s)' % weight
+        else:
+            value = 'SUM(%s * %s) / SUM(%s)' % (score, weight, weight)
+        db_now = connection.ops.value_to_db_datetime(now)
+        seconds = total_seconds(half_life)
+        select_params = [db_now, seconds] * value.count('POWER')
+
+    sql = 'SELECT %s FROM %s r1 WHERE %s' % (value, qn(opts.db_table), where)
+    return sql, select_params + params
 
-    if isinstance(factor_a, User):
-        filter_field = 'user_id'
-        match_on = 'hashed'
-        lookup_a = factor_a.pk
-        lookup_b = factor_b.pk
+
+# similarity statements by template and rating queryset shape, and the
+# compiled filter of each rating queryset that has been compared on
+_similarity_sql_cache = {}
+_queryset_filter_cache = weakref.WeakKeyDictionary()
+
+
+def get_queryset_filter(ratings_queryset):
+    """
+    Returns the SQL and parameters restricting a similarity query to the
+    ratings in ratings_queryset.  The queryset is only compiled the first time
+    it is compared on.
+    """
+    try:
+        return _queryset_filter_cache[ratings_queryset]
+    except KeyError:
+        pass
+
+    rating_query = ratings_queryset.values_list('pk').query
+    if query_has_where(rating_query):
+        queryset_filter = ('', ())
     else:
-        filter_field = 'hashed'
-        match_on = 'user_id'
-        lookup_a = rating_model(content_object=factor_a).generate_hash()
-        lookup_b = rating_model(content_object=factor_b).generate_hash()
+        q, p = query_as_sql(rating_query)
+        queryset_filter = (' AND r1.id IN (%s)' % q, tuple(p))
+
+    _queryset_filter_cache[ratings_queryset] = queryset_filter
+    return queryset_filter
+
+
+def prepare_similarity_sql(sql, ratings_queryset, filter_field, match_on):
+    """
+    Fills in the table, columns and queryset filter of a similarity query
+    template, returning the statement and the parameters of the queryset
+    filter.  The factors being compared are left as placeholders, so the
+    statement text is built once per shape and reused for every pair.
+    """
+    queryset_filter, params = get_queryset_filter(ratings_queryset)
+    db_table = ratings_queryset.model._meta.db_table
+    key = (sql, db_table, filter_field, match_on, queryset_filter)
+
+    try:
+        statement = _similarity_sql_cache[key]
+    except KeyError:
+        qn = connection.ops.quote_name
+        statement = _similarity_sql_cache[key] = sql % {
+            'ratings_table': qn(db_table),
+            'filter_field': qn(filter_field),
+            'match_on': qn(match_on),
+            'queryset_filter': queryset_filter,
+        }
+    return statement, list(params)
+
+
+def similarity_lookup(rating_model, factor):
+    """
+    Returns the column ratings of factor are found by, the column its ratings
+    are matched with those of another factor on, and the value identifying
+    factor
+    """
+    if isinstance(factor, User):
+        return 'user_id', ITEM_KEY, factor.pk
+    return ITEM_KEY, 'user_id', item_key(rating_model, factor)
+
+
+def item_key(rating_model, item):
+    """
+    Returns the value of the ITEM_KEY column identifying item
+    """
+    if ITEM_KEY == 'item_key':
+        return rating_model.item_key_for(item)
+    return rating_model.hash_for(item)
+
+
+def similarity_candidates(rating_model, candidates):
+    """
+    Returns a dictionary of lookup value -> factor for the candidates.  A
+    dictionary is returned unchanged, so callers comparing many factors
+    against the same candidates can build it once.
+    """
+    if isinstance(candidates, dict):
+        return candidates
+    return dict((similarity_lookup(rating_model, candidate)[2], candidate)
+                for candidate in candidates)
+
+
+@instrumented()
+def sim_euclidean_distance(ratings_queryset, factor_a, factor_b):
+    rating_model = ratings_queryset.model
+
+    filter_field, match_on, lookup_a = similarity_lookup(rating_model,
+                                                         factor_a)
+    lookup_b = similarity_lookup(rating_model, factor_b)[2]
 
     sql = """
     SELECT r1.score - r2.score AS diff
@@ -61,30 +424,16 @@ def sim_euclidean_distance(ratings_queryset, factor_a, factor_b):
         %(ratings_table)s AS r2
     ON r1.%(match_on)s = r2.%(match_on)s
     WHERE
-        r1.%(filter_field)s = '%(lookup_a)s' AND
-        r2.%(filter_field)s = '%(lookup_b)s'
+        r1.%(filter_field)s = %%s AND
+        r2.%(filter_field)s = %%s
         %(queryset_filter)s
     """
 
-    rating_query = ratings_queryset.values_list('pk').query
-    if query_has_where(rating_query):
-        queryset_filter = ''
-    else:
-        q, p = query_as_sql(rating_query)
-        rating_qs_sql = q % p
-        queryset_filter = ' AND r1.id IN (%s)' % rating_qs_sql
-
-    params = {
-        'ratings_table': rating_model._meta.db_table,
-        'filter_field': filter_field,
-        'match_on': match_on,
-        'lookup_a': lookup_a,
-        'lookup_b': lookup_b,
-        'queryset_filter': queryset_filter
-    }
+    sql, params = prepare_similarity_sql(sql, ratings_queryset, filter_field,
+                                         match_on)
 
     cursor = connection.cursor()
-    cursor.execute(sql % params)
+    cursor.execute(sql, [lookup_a, lookup_b] + params)
 
     sum_of_squares = 0
     while True:
@@ -93,22 +442,24 @@ def sim_euclidean_distance(ratings_queryset, factor_a, factor_b):
             break
         sum_of_squares += result[0] ** 2
 
+    return euclidean_from_sums(sum_of_squares)
+
+
+def euclidean_from_sums(sum_of_squares):
+    """
+    Convert the summed squared differences between two factors into a
+    similarity score in the range (0, 1]
+    """
     return 1 / (1 + sum_of_squares)
 
 
+@instrumented()
 def sim_pearson_correlation(ratings_queryset, factor_a, factor_b):
     rating_model = ratings_queryset.model
 
-    if isinstance(factor_a, User):
-        filter_field = 'user_id'
-        match_on = 'hashed'
-        lookup_a = factor_a.pk
-        lookup_b = factor_b.pk
-    else:
-        filter_field = 'hashed'
-        match_on = 'user_id'
-        lookup_a = rating_model(content_object=factor_a).generate_hash()
-        lookup_b = rating_model(content_object=factor_b).generate_hash()
+    filter_field, match_on, lookup_a = similarity_lookup(rating_model,
+                                                         factor_a)
+    lookup_b = similarity_lookup(rating_model, factor_b)[2]
 
     sql = """
     SELECT
@@ -124,38 +475,30 @@ def sim_pearson_correlation(ratings_queryset, factor_a, factor_b):
         %(ratings_table)s AS r2
     ON r1.%(match_on)s = r2.%(match_on)s
     WHERE
-        r1.%(filter_field)s = '%(lookup_a)s' AND
-        r2.%(filter_field)s = '%(lookup_b)s'
+        r1.%(filter_field)s = %%s AND
+        r2.%(filter_field)s = %%s
         %(queryset_filter)s
     """
 
-    rating_query = ratings_queryset.values_list('pk').query
-    if query_has_where(rating_query):
-        queryset_filter = ''
-    else:
-        q, p = query_as_sql(rating_query)
-        rating_qs_sql = q % p
-        queryset_filter = ' AND r1.id IN (%s)' % rating_qs_sql
-
-    params = {
-        'ratings_table': rating_model._meta.db_table,
-        'filter_field': filter_field,
-        'match_on': match_on,
-        'lookup_a': lookup_a,
-        'lookup_b': lookup_b,
-        'queryset_filter': queryset_filter
-    }
+    sql, params = prepare_similarity_sql(sql, ratings_queryset, filter_field,
+                                         match_on)
 
     cursor = connection.cursor()
-    cursor.execute(sql % params)
+    cursor.execute(sql, [lookup_a, lookup_b] + params)
 
     result = cursor.fetchone()
 
     if not result:
         return 0
 
-    sum1, sum2, sum1_sq, sum2_sq, psum, sample_size = result
+    return pearson_from_sums(*result)
 
+
+def pearson_from_sums(sum1, sum2, sum1_sq, sum2_sq, psum, sample_size):
+    """
+    Calculate the pearson correlation from the sums collected over the
+    co-rated samples of two factors
+    """
     if sum1 is None or sum2 is None or sample_size == 0:
         return 0
 
@@ -169,51 +512,441 @@ def sim_pearson_correlation(ratings_queryset, factor_a, factor_b):
     return num / den
 
 
+EUCLIDEAN_MANY_SQL = """
+    SELECT
+        r2.%(filter_field)s,
+        SUM((r1.score - r2.score) * (r1.score - r2.score)) AS sum_of_squares
+    FROM
+        %(ratings_table)s AS r1
+    INNER JOIN
+        %(ratings_table)s AS r2
+    ON r1.%(match_on)s = r2.%(match_on)s
+    WHERE
+        r1.%(filter_field)s = %%s
+        %(queryset_filter)s
+    GROUP BY r2.%(filter_field)s
+    """
+
+PEARSON_MANY_SQL = """
+    SELECT
+        r2.%(filter_field)s,
+        SUM(r1.score) AS r1_sum,
+        SUM(r2.score) AS r2_sum,
+        SUM(r1.score*r1.score) AS r1_square_sum,
+        SUM(r2.score*r2.score) AS r2_square_sum,
+        SUM(r1.score*r2.score) AS p_sum,
+        COUNT(r1.id) AS sample_size
+    FROM
+        %(ratings_table)s AS r1
+    INNER JOIN
+        %(ratings_table)s AS r2
+    ON r1.%(match_on)s = r2.%(match_on)s
+    WHERE
+        r1.%(filter_field)s = %%s
+        %(queryset_filter)s
+    GROUP BY r2.%(filter_field)s
+    """
+
+
+@instrumented()
+def sim_euclidean_many(ratings_queryset, factor, candidates):
+    """
+    Returns a list of (euclidean distance score, candidate) for each of the
+    candidates sharing at least one rating with factor, using a single query
+    """
+    return list(iter_similarities(ratings_queryset, factor, candidates,
+                                  sim_euclidean_distance))
+
+
+@instrumented()
+def sim_pearson_many(ratings_queryset, factor, candidates):
+    """
+    Returns a list of (pearson correlation, candidate) for each of the
+    candidates sharing at least one rating with factor, using a single query
+    """
+    return list(iter_similarities(ratings_queryset, factor, candidates,
+                                  sim_pearson_correlation))
+
+
+def iter_similarities(ratings_queryset, factor, candidates, similarity):
+    """
+    Yields (similarity score, candidate) for each of the candidates sharing
+    at least one rating with factor, streaming the rows of a single query.
+    Candidate users may be given as a queryset, which is then matched
+    against a chunk of rows at a time instead of being loaded whole.
+    """
+    if similarity is sim_euclidean_distance:
+        sql = EUCLIDEAN_MANY_SQL
+        from_sums = lambda sums: euclidean_from_sums(sums[0])
+    else:
+        sql = PEARSON_MANY_SQL
+        from_sums = lambda sums: pearson_from_sums(*sums)
+
+    for candidate, sums in _similarity_sums(sql, ratings_queryset, factor,
+                                            candidates):
+        yield from_sums(sums), candidate
+
+
+def _similarity_sums(sql, ratings_queryset, factor, candidates):
+    # run a grouped similarity query and yield (candidate, sums) for each
+    # candidate found among the rows, skipping factor itself
+    rating_model = ratings_queryset.model
+    filter_field, match_on, lookup = similarity_lookup(rating_model, factor)
+    if not (filter_field == 'user_id' and
+            isinstance(candidates, models.query.QuerySet)):
+        candidates = similarity_candidates(rating_model, candidates)
+
+    sql, params = prepare_similarity_sql(sql, ratings_queryset, filter_field,
+                                         match_on)
+    cursor = connection.cursor()
+    cursor.execute(sql, [lookup] + params)
+
+    while True:
+        rows = cursor.fetchmany(SIMILAR_ITEMS_CHUNK_SIZE)
+        if not rows:
+            break
+        rows = [row for row in rows if row[0] != lookup]
+        if isinstance(candidates, models.query.QuerySet):
+            found = candidates.in_bulk([row[0] for row in rows])
+        else:
+            found = candidates
+        for row in rows:
+            if row[0] in found:
+                yield found[row[0]], row[1:]
+
+
+# similarity functions with a counterpart scoring one factor against many
+# candidates in a single query
+MANY_SIMILARITIES = {
+    sim_pearson_correlation: sim_pearson_many,
+    sim_euclidean_distance: sim_euclidean_many,
+}
+
+
+@instrumented()
 def top_matches(ratings_queryset, items, item, n=5,
                 similarity=sim_pearson_correlation):
-    scores = [(similarity(ratings_queryset, item, other), other)
-              for other in items if other != item]
-    scores.sort()
-    scores.reverse()
-    return scores[:n]
+    many = MANY_SIMILARITIES.get(similarity)
+    if many is not None:
+        # only items sharing a rating with item are scored
+        scores = many(ratings_queryset, item, items)
+    else:
+        if isinstance(items, dict):
+            items = items.values()
+        scores = [(similarity(ratings_queryset, item, other), other)
+                  for other in items if other != item]
+    return heapq.nlargest(n, scores, key=itemgetter(0))
 
 
-def recommendations(ratings_queryset, people, person,
+# default number of bands and of hyperplanes per band used by LSHMatrix
+LSH_BANDS = 16
+LSH_ROWS = 4
+
+# similarity functions that RatingsMatrix knows how to compute in memory
+MATRIX_SIMILARITIES = (sim_pearson_correlation, sim_euclidean_distance)
+
+
+class RatingsMatrix(object):
+    """
+    A sparse, in-memory copy of a ratings queryset loaded with a single query.
+
+    Scores are stored twice, once keyed by item hash and once keyed by user id,
+    so the similarity between one factor and every factor sharing a rating
+    with it can be computed in a single pass instead of one self-join per pair.
+    The scores match those of the SQL similarity functions.
+
+    A :class:`~ratings.snapshot.RatingsSnapshot` may be passed instead of a
+    queryset, in which case the scores are read from the mapped file instead
+    of being copied into this process.
+    """
+    def __init__(self, ratings_queryset):
+        from ratings.snapshot import RatingsSnapshot
+        if isinstance(ratings_queryset, RatingsSnapshot):
+            self.rating_model = ratings_queryset.rating_model
+            self.items = ratings_queryset.items
+            self.users = ratings_queryset.users
+            return
+
+        self.rating_model = ratings_queryset.model
+        self.items = {}
+        self.users = {}
+
+        rows = ratings_queryset.values_list(ITEM_KEY, 'user', 'score')
+        for key, user_id, score in rows.iterator():
+            self.items.setdefault(key, {})[user_id] = score
+            self.users.setdefault(user_id, {})[key] = score
+
+    def item_similarities(self, hashed, candidates=None,
+                          similarity=sim_pearson_correlation):
+        """
+        Returns a dictionary of item hash -> similarity for every item that
+        shares a rater with the given item hash
+        """
+        return self._similarities(self.items, self.users, hashed, candidates,
+                                  similarity)
+
+    def user_similarities(self, user_id, candidates=None,
+                          similarity=sim_pearson_correlation):
+        """
+        Returns a dictionary of user id -> similarity for every user that
+        shares a rated item with the given user id
+        """
+        return self._similarities(self.users, self.items, user_id, candidates,
+                                  similarity)
+
+    def _similarities(self, vectors, index, key, candidates, similarity):
+        if similarity not in MATRIX_SIMILARITIES:
+            raise ValueError('%r cannot be computed in memory' % similarity)
+
+        # sums are collected in the same shape as the pearson SQL query, plus
+        # the sum of squared differences needed by the euclidean distance
+        sums = {}
+        for match_key, score in vectors.get(key, {}).iteritems():
+            for other, other_score in index[match_key].iteritems():
+                if other == key:
+                    continue
+                if candidates is not None and other not in candidates:
+                    continue
+                acc = sums.get(other)
+                if acc is None:
+                    acc = sums[other] = [0, 0, 0, 0, 0, 0, 0]
+                acc[0] += score
+                acc[1] += other_score
+                acc[2] += score * score
+                acc[3] += other_score * other_score
+                acc[4] += score * other_score
+                acc[5] += 1
+                acc[6] += (score - other_score) ** 2
+
+        return dict((other, _similarity_from_sums(acc, similarity))
+                    for other, acc in sums.iteritems())
+
+    def top_matches(self, candidates, item, n=5,
                     similarity=sim_pearson_correlation):
+        """
+        In-memory counterpart of :func:`top_matches`, where ``candidates`` is
+        a dictionary of item hash -> item.  Candidates that share no raters
+        with ``item`` are not scored.
+        """
+        scores = self.item_similarities(item_key(self.rating_model, item),
+                                        candidates, similarity)
+        return heapq.nlargest(n, [(score, candidates[other])
+                                  for other, score in scores.iteritems()],
+                              key=itemgetter(0))
+
+
+def _similarity_from_sums(acc, similarity):
+    if similarity is sim_euclidean_distance:
+        return euclidean_from_sums(acc[6])
+    return pearson_from_sums(*acc[:6])
+
+
+class LSHMatrix(RatingsMatrix):
+    """
+    A RatingsMatrix which only scores an item against the items likely to be
+    similar to it, found by locality sensitive hashing.
+
+    Every item's mean-centered rating vector is projected onto bands * rows
+    random hyperplanes.  Items whose signs agree on all the hyperplanes of at
+    least one band become candidates, and only those are scored exactly.
+    More bands find more of the true neighbours at the cost of scoring more
+    pairs, more rows per band make the candidates fewer but more alike.
+    """
+    def __init__(self, ratings_queryset, bands=None, rows=None, seed=0):
+        super(LSHMatrix, self).__init__(ratings_queryset)
+        self.bands = bands or LSH_BANDS
+        self.rows = rows or LSH_ROWS
+        self.seed = seed
+
+        planes = self.bands * self.rows
+        weights = {}
+        for user_id in self.users:
+            # seeded per user so the first hyperplanes stay the same
+            # whatever the number of bands
+            rng = random.Random(hash((seed, user_id)))
+            weights[user_id] = [rng.gauss(0, 1) for i in range(planes)]
+
+        self.buckets = {}
+        self.signatures = {}
+        for hashed, vector in self.items.iteritems():
+            mean = sum(vector.itervalues()) / len(vector)
+            projection = [0.0] * planes
+            for user_id, score in vector.iteritems():
+                centered = score - mean
+                user_weights = weights[user_id]
+                for i in range(planes):
+                    projection[i] += centered * user_weights[i]
+            bits = tuple(value >= 0 for value in projection)
+            signature = [(band, bits[band * self.rows:(band + 1) * self.rows])
+                         for band in range(self.bands)]
+            self.signatures[hashed] = signature
+            for bucket in signature:
+                self.buckets.setdefault(bucket, []).append(hashed)
 
-    already_rated = ratings_queryset.filter(user=person).values_list('hashed')
+    def neighbours(self, hashed):
+        """
+        Returns the hashes of the items sharing a bucket with hashed
+        """
+        found = set()
+        for bucket in self.signatures.get(hashed, ()):
+            found.update(self.buckets[bucket])
+        found.discard(hashed)
+        return found
+
+    def item_similarities(self, hashed, candidates=None,
+                          similarity=sim_pearson_correlation):
+        if similarity not in MATRIX_SIMILARITIES:
+            raise ValueError('%r cannot be computed in memory' % similarity)
+
+        vector = self.items.get(hashed, {})
+        scores = {}
+        for other in self.neighbours(hashed):
+            if candidates is not None and other not in candidates:
+                continue
+            other_vector = self.items[other]
+            acc = [0, 0, 0, 0, 0, 0, 0]
+            for user_id, score in vector.iteritems():
+                if user_id not in other_vector:
+                    continue
+                other_score = other_vector[user_id]
+                acc[0] += score
+                acc[1] += other_score
+                acc[2] += score * score
+                acc[3] += other_score * other_score
+                acc[4] += score * other_score
+                acc[5] += 1
+                acc[6] += (score - other_score) ** 2
+            if acc[5]:
+                scores[other] = _similarity_from_sums(acc, similarity)
+        return scores
+
+
+@instrumented()
+def lsh_recall(ratings_queryset, num=10, bands=None, rows=None, sample=100,
+               seed=0):
+    """
+    Returns the share of the exact top num matches of a random sample of the
+    rated items that the lsh engine finds as well, between 0 and 1
+    """
+    matrix = LSHMatrix(ratings_queryset, bands, rows, seed)
+    items = sorted(matrix.items)
+    rng = random.Random(seed)
+    sampled = rng.sample(items, min(sample, len(items)))
+
+    expected = found = 0
+    for hashed in sampled:
+        exact = RatingsMatrix.item_similarities(matrix, hashed)
+        approximate = matrix.item_similarities(hashed)
+        exact_top = heapq.nlargest(num, exact.iteritems(), key=itemgetter(1))
+        approximate_top = heapq.nlargest(num, approximate.iteritems(),
+                                         key=itemgetter(1))
+        expected += len(exact_top)
+        found += len(set(dict(exact_top)) & set(dict(approximate_top)))
+
+    if not expected:
+        return 1.0
+    return float(found) / expected
+
+
+@instrumented()
+def recommendations(ratings_queryset, people, person,
+                    similarity=sim_pearson_correlation, k=None, n=None):
+    """
+    Returns a list of (predicted score, object) for the objects person has
+    not rated, predicted from the ratings of the people most like them.  Only
+    the k most similar people are consulted and the n best objects returned,
+    if given.  Ratings are streamed as plain values and only the returned
+    objects are loaded.  people may be a queryset of users, of which only
+    the ones sharing a rating with person are loaded.
+    """
+    if similarity in MANY_SIMILARITIES:
+        similarities = iter_similarities(ratings_queryset, person, people,
+                                         similarity)
+    else:
+        similarities = ((similarity(ratings_queryset, person, other), other)
+                        for other in people if other != person)
+
+    # only the k most similar people are held while the others stream past
+    neighbours = ((sim, other.pk) for sim, other in similarities if sim > 0)
+    if k is not None:
+        neighbours = heapq.nlargest(k, neighbours, key=itemgetter(0))
+    sims = dict((pk, sim) for sim, pk in neighbours)
+
+    already_rated = ratings_queryset.filter(user=person).values_list(ITEM_KEY)
 
     totals = {}
     sim_sums = {}
 
-    for other in people:
-        if other == person:
-            continue
+    for chunk in chunked(sims.keys(), SIMILAR_ITEMS_CHUNK_SIZE):
+        items = (ratings_queryset.filter(user__in=chunk)
+                                 .exclude(**{'%s__in' % ITEM_KEY:
+                                             already_rated}))
 
-        sim = similarity(ratings_queryset, person, other)
+        # now, score the items person hasn't rated yet
+        for key, user_id, score in content_keys(items, 'user', 'score'):
+            sim = sims[user_id]
 
-        if sim <= 0:
-            continue
+            totals.setdefault(key, 0)
+            totals[key] += (score * sim)
 
-        items = (ratings_queryset.filter(user=other)
-                                 .exclude(hashed__in=already_rated))
+            sim_sums.setdefault(key, 0)
+            sim_sums[key] += sim
 
-        # now, score the items person hasn't rated yet
-        for item in items:
-            totals.setdefault(item.content_object, 0)
-            totals[item.content_object] += (item.score * sim)
+    rankings = [(total / sim_sums[key], key)
+                for key, total in totals.iteritems()]
+
+    if n is None:
+        rankings.sort(key=itemgetter(0), reverse=True)
+    else:
+        rankings = heapq.nlargest(n, rankings, key=itemgetter(0))
+    return resolve_objects(rankings)
+
+
+def content_keys(ratings_queryset, *fields):
+    """
+    Yields ((content type id, object id),) followed by the given fields for
+    every rating in the queryset, streamed as plain values
+    """
+    field = get_content_object_field(ratings_queryset.model)
+    if is_gfk(field):
+        rows = ratings_queryset.values_list(field.ct_field, field.fk_field,
+                                            *fields)
+        for row in rows.iterator():
+            yield ((row[0], row[1]),) + row[2:]
+    else:
+        ctype_id = ContentType.objects.get_for_model(field.rel.to).pk
+        rows = ratings_queryset.values_list(field.name, *fields)
+        for row in rows.iterator():
+            yield ((ctype_id, row[0]),) + row[1:]
+
+
+# number of items whose neighbours are written to the database at once
+SIMILAR_ITEMS_CHUNK_SIZE = 500
 
-            sim_sums.setdefault(item.content_object, 0)
-            sim_sums[item.content_object] += sim
+# "sql" issues one self-join per pair of items, "memory" loads the ratings
+# into a RatingsMatrix once and scores every pair from there, "lsh" loads them
+# into an LSHMatrix and only scores the pairs likely to be similar
+SIMILARITY_ENGINES = ('sql', 'memory', 'lsh')
 
-    rankings = [(total / sim_sums[pk], pk) for pk, total in totals.iteritems()]
 
-    rankings.sort()
-    rankings.reverse()
-    return rankings
+@instrumented()
+def calculate_similar_items(ratings_queryset, num=10, engine='sql',
+                            incremental=False, workers=1, bands=None,
+                            snapshot=None):
+    if engine not in SIMILARITY_ENGINES:
+        raise ValueError('Unknown similarity engine: %r' % engine)
+    if snapshot is not None and engine == 'sql':
+        raise ValueError('A snapshot requires the memory or lsh engine')
 
+    # the in-memory engines read the scores from a snapshot when given one
+    source = ratings_queryset if snapshot is None else snapshot
+
+    matrix = None
+    if engine == 'memory':
+        matrix = RatingsMatrix(source)
+    elif engine == 'lsh':
+        matrix = LSHMatrix(source, bands)
 
-def calculate_similar_items(ratings_queryset, num=10):
     # get distinct items from the ratings queryset - this can be optimized
     field = get_content_object_field(ratings_queryset.model)
 
@@ -226,58 +959,257 @@ def calculate_similar_items(ratings_queryset, num=10):
             rating_ids = ratings_subset.values_list('object_id')
             model_class = ctype.model_class()
             queryset = model_class._default_manager.filter(pk__in=rating_ids)
-            _store_top_matches(ratings_queryset, queryset, num, True)
+            _store_top_matches(ratings_queryset, queryset, num, True, matrix,
+                               incremental, workers)
     else:
         rated_model = field.rel.to
         rating_ids = ratings_queryset.values_list('content_object__pk')
         queryset = rated_model._default_manager.filter(pk__in=rating_ids)
-        _store_top_matches(ratings_queryset, queryset, num, False)
+        _store_top_matches(ratings_queryset, queryset, num, False, matrix,
+                           incremental, workers)
 
+    ratings_cache.invalidate_all()
 
-def _store_top_matches(ratings_queryset, rated_queryset, num, is_gfk):
-    from ratings.models import SimilarItem
+
+def _store_top_matches(ratings_queryset, rated_queryset, num, is_gfk,
+                       matrix=None, incremental=False, workers=1):
+    from ratings.models import DirtyItem
 
     ctype = ContentType.objects.get_for_model(rated_queryset.model)
     rated_queryset.values_list('pk')  # fill cache
 
-    for item in rated_queryset.iterator():
-        matches = top_matches(ratings_queryset, rated_queryset, item, num)
-        for (score, match) in matches:
-            si, created = SimilarItem.objects.get_or_create(
-                content_type=ctype,
-                object_id=item.pk,
-                similar_content_type=ContentType.objects.get_for_model(match),
-                similar_object_id=match.pk)
-            if created or si.score != score:
-                si.score = score
-                si.save()
+    # read the log up front, items marked while we work stay dirty
+    dirty = dict(DirtyItem.objects.filter(content_type=ctype)
+                                  .values_list('pk', 'object_id'))
+
+    only = None
+    if incremental:
+        if not dirty:
+            return
+        only = _affected_items(ratings_queryset, ctype, set(dirty.values()))
+
+        # items which lost all their ratings have no neighbours any more
+        rated = set(rated_queryset.values_list('pk', flat=True))
+        unrated = set(dirty.values()) - rated
+        if unrated:
+            store_similar_items(ctype, dict((pk, []) for pk in unrated))
+
+    candidates = similarity_candidates(ratings_queryset.model,
+                                       rated_queryset.iterator())
+
+    keys = [key for key, item in candidates.iteritems()
+            if only is None or item.pk in only]
+
+    # the workers need the connection closed, which would throw away the
+    # work of an open transaction, so they are only used outside of one
+    if (workers > 1 and len(keys) > 1 and hasattr(os, 'fork') and
+            not in_transaction()):
+        results = _parallel_top_matches(ratings_queryset, candidates, matrix,
+                                        keys, num, workers)
+    else:
+        results = (_item_top_matches(ratings_queryset, candidates, matrix,
+                                     key, num) for key in keys)
+
+    for chunk in chunked(results, SIMILAR_ITEMS_CHUNK_SIZE):
+        store_similar_items(ctype, dict(chunk))
+
+    for chunk in chunked(dirty.keys(), SIMILAR_ITEMS_CHUNK_SIZE):
+        DirtyItem.objects.filter(pk__in=chunk).delete()
+
+
+def _item_top_matches(ratings_queryset, candidates, matrix, key, num):
+    # returns the pk of the candidate stored under key and its top matches
+    # as [(score, pk), ...]
+    item = candidates[key]
+    if matrix is None:
+        matches = top_matches(ratings_queryset, candidates, item, num)
+    else:
+        matches = matrix.top_matches(candidates, item, num)
+    return item.pk, [(score, match.pk) for score, match in matches]
+
+
+# arguments shared with the worker processes of _parallel_top_matches
+_worker_state = None
+
+
+def _parallel_top_matches(ratings_queryset, candidates, matrix, keys, num,
+                          workers):
+    """
+    Calculates the top matches of the candidates stored under keys in a pool
+    of worker processes, each scoring an interleaved shard of the keys over
+    its own database connection
+    """
+    global _worker_state
+
+    # the workers are forked after this is set, so they inherit the
+    # candidates and the matrix instead of having them pickled
+    _worker_state = (ratings_queryset, candidates, matrix, num)
+
+    # a connection must not be shared across processes, so drop ours and
+    # let every worker open its own
+    for conn in connections.all():
+        conn.close()
+
+    keys = sorted(keys)
+    shards = [keys[i::workers] for i in range(workers)]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_top_matches_worker, shards)
+    finally:
+        pool.close()
+        pool.join()
+        _worker_state = None
 
+    return itertools.chain.from_iterable(results)
 
-def recommended_items(ratings_queryset, user):
+
+def _top_matches_worker(keys):
+    ratings_queryset, candidates, matrix, num = _worker_state
+    return [_item_top_matches(ratings_queryset, candidates, matrix, key, num)
+            for key in keys]
+
+
+def _affected_items(ratings_queryset, ctype, object_ids):
+    """
+    Returns the ids of the given objects plus those of every object whose
+    neighbours may have changed along with them: objects sharing a rater
+    with them and objects currently listing them as similar
+    """
+    from ratings.models import SimilarItem
+
+    field = get_content_object_field(ratings_queryset.model)
+    if is_gfk(field):
+        key = field.fk_field
+        ratings_subset = ratings_queryset.filter(content_type=ctype)
+    else:
+        key = field.name
+        ratings_subset = ratings_queryset
+
+    affected = set(object_ids)
+    for chunk in chunked(object_ids, SIMILAR_ITEMS_CHUNK_SIZE):
+        raters = ratings_subset.filter(**{'%s__in' % key: chunk}) \
+                               .values_list('user', flat=True)
+        co_rated = ratings_subset.filter(user__in=raters) \
+                                 .values_list(key, flat=True).distinct()
+        affected.update(co_rated)
+
+        listing = SimilarItem.objects.filter(similar_content_type=ctype,
+                                             similar_object_id__in=chunk)
+        affected.update(listing.values_list('object_id', flat=True))
+    return affected
+
+
+def store_similar_items(ctype, matches):
+    """
+    Synchronize the stored neighbours of a batch of items of the given content
+    type with ``matches``, a dictionary of object id -> [(score, similar
+    object id), ...].  Unchanged rows are left alone, new and rescored rows
+    are written with ``bulk_create`` and neighbours no longer present are
+    deleted, all in one transaction.
+    """
     from ratings.models import SimilarItem
+
+    wanted = {}
+    for object_id, neighbours in matches.iteritems():
+        for score, similar_object_id in neighbours:
+            wanted[(object_id, similar_object_id)] = score
+
+    existing = SimilarItem.objects.filter(
+        content_type=ctype,
+        object_id__in=matches.keys(),
+    ).values_list('pk', 'object_id', 'similar_content_type',
+                  'similar_object_id', 'score')
+
+    with atomic():
+        stale = []
+        for pk, object_id, similar_ctype, similar_object_id, score in existing:
+            key = (object_id, similar_object_id)
+            if similar_ctype == ctype.pk and wanted.get(key) == score:
+                del wanted[key]
+            else:
+                # stale neighbours and rescored ones, which are re-created
+                stale.append(pk)
+
+        for chunk in chunked(stale, SIMILAR_ITEMS_CHUNK_SIZE):
+            SimilarItem.objects.filter(pk__in=chunk).delete()
+
+        new_items = [
+            SimilarItem(content_type=ctype, object_id=object_id,
+                        similar_content_type=ctype,
+                        similar_object_id=similar_object_id, score=score)
+            for (object_id, similar_object_id), score in wanted.iteritems()]
+        for chunk in chunked(new_items, SIMILAR_ITEMS_CHUNK_SIZE):
+            SimilarItem.objects.bulk_create(chunk)
+
+
+@instrumented()
+def recommended_items(ratings_queryset, user, n=None):
+    """
+    Returns a list of (predicted score, object) for the objects similar to
+    those user has rated but which user has not rated yet, best first, using
+    a fixed number of queries per rated content type
+    """
+    from ratings.models import SimilarItem
+
+    # (content type id, object id) -> scores, the objects rated by user
+    user_scores = {}
+    for key, score in content_keys(ratings_queryset.filter(user=user),
+                                   'score'):
+        user_scores.setdefault(key, []).append(score)
+
+    by_ctype = {}
+    for ctype_id, object_id in user_scores:
+        by_ctype.setdefault(ctype_id, []).append(object_id)
+
     scores = {}
     total_sim = {}
 
-    for item in ratings_queryset.filter(user=user):
-        similar_items = SimilarItem.objects.get_for_item(item.content_object)
-        for similar_item in similar_items:
+    for ctype_id, object_ids in by_ctype.iteritems():
+        for chunk in chunked(object_ids, SIMILAR_ITEMS_CHUNK_SIZE):
+            similar_items = SimilarItem.objects.filter(
+                content_type=ctype_id,
+                object_id__in=chunk,
+            ).values_list('object_id', 'similar_content_type',
+                          'similar_object_id', 'score')
 
-            actual = similar_item.similar_object
-            lookup_kwargs = ratings_queryset.model.lookup_kwargs(actual)
-            lookup_kwargs['user'] = user
+            for object_id, similar_ctype_id, similar_id, sim in similar_items:
+                actual = (similar_ctype_id, similar_id)
+                if actual in user_scores:
+                    continue
 
-            if ratings_queryset.filter(**lookup_kwargs):
-                continue
+                for score in user_scores[(ctype_id, object_id)]:
+                    scores.setdefault(actual, 0)
+                    scores[actual] += sim * score
+
+                    total_sim.setdefault(actual, 0)
+                    total_sim[actual] += sim
 
-            scores.setdefault(actual, 0)
-            scores[actual] += similar_item.score * item.score
+    rankings = [(score / total_sim[key], key)
+                for key, score in scores.iteritems() if total_sim[key]]
+    rankings.sort(key=itemgetter(0), reverse=True)
+    if n is not None:
+        rankings = rankings[:n]
 
-            total_sim.setdefault(actual, 0)
-            total_sim[actual] += similar_item.score
+    return resolve_objects(rankings)
+
+
+def resolve_objects(rankings):
+    """
+    Replaces the (content type id, object id) keys of a list of (score, key)
+    with the objects they refer to, using one query per content type.
+    Objects which no longer exist are dropped.
+    """
+    by_ctype = {}
+    for score, (ctype_id, object_id) in rankings:
+        by_ctype.setdefault(ctype_id, []).append(object_id)
 
-    rankings = [(score / total_sim[item], item)
-                for item, score in scores.iteritems()]
+    objects = {}
+    for ctype_id, object_ids in by_ctype.iteritems():
+        model_class = ContentType.objects.get_for_id(ctype_id).model_class()
+        manager = model_class._default_manager
+        for chunk in chunked(object_ids, SIMILAR_ITEMS_CHUNK_SIZE):
+            for pk, obj in manager.in_bulk(chunk).iteritems():
+                objects[(ctype_id, pk)] = obj
 
-    rankings.sort()
-    rankings.reverse()
-    return rankings
+    return [(score, objects[key]) for score, key in rankings if key in objects]
@@ -1,18 +1,36 @@
+import json
+
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.decorators import login_required
+from django.core.exceptions import ValidationError
 from django.http import HttpResponse, HttpResponseRedirect, \
     HttpResponseNotAllowed, Http404
 from django.http import HttpResponseBadRequest
 from django.shortcuts import get_object_or_404
 from django.utils.http import is_safe_url
 
+from ratings import background
+from ratings.buffer import buffer_vote
+from ratings.utils import atomic
+
 
 # allow GET requests to create ratings -- this goes against the "GET" requests
 # should be idempotent but avoids the necessity of using <form> elements or
 # javascript to create rating links
 ALLOW_GET = getattr(settings, 'RATINGS_ALLOW_GET', True)
 
+# queue votes in the vote buffer instead of writing them right away, they are
+# stored by ratings.buffer.flush_votes() or the flush_rating_votes command
+BUFFER_VOTES = getattr(settings, 'RATINGS_BUFFER_VOTES', False)
+
+# store votes from a background thread, responding without waiting for the
+# database
+BACKGROUND_VOTES = getattr(settings, 'RATINGS_BACKGROUND_VOTES', False)
+
+# the most votes a single request to rate_objects may carry
+MAX_BATCH_SIZE = getattr(settings, 'RATINGS_MAX_BATCH_SIZE', 100)
+
 
 @login_required
 def rate_object(request, ct, pk, score=1, add=True):
@@ -26,23 +44,136 @@ def rate_object(request, ct, pk, score=1, add=True):
     if not redirect_url:
         redirect_url = '/'
 
-    ctype = get_object_or_404(ContentType, pk=ct)
+    try:
+        ctype = ContentType.objects.get_for_id(int(ct))
+    except ContentType.DoesNotExist:
+        raise Http404('No content type %s' % ct)
     model_class = ctype.model_class()
 
     if not hasattr(model_class, '_ratings_field'):
         raise Http404('Model class %s does not support ratings' % model_class)
 
+    if add:
+        score = '.' in score and float(score) or int(score)
+
+    if BUFFER_VOTES or BACKGROUND_VOTES:
+        # the object is not looked up, votes for missing objects are dropped
+        # when they are stored
+        try:
+            pk = model_class._meta.pk.to_python(pk)
+        except ValidationError:
+            raise Http404('Invalid primary key: %s' % pk)
+        if BUFFER_VOTES:
+            buffer_vote(ctype.pk, pk, request.user.pk, score if add else None)
+        else:
+            background.run_in_background(background.rate_object, ctype.pk,
+                                         pk, request.user.pk,
+                                         score if add else None)
+        return _rated_response(request, redirect_url)
+
     obj = get_object_or_404(model_class, pk=pk)
 
     ratings_descriptor = getattr(obj, obj._ratings_field)
 
     if add:
-        score = '.' in score and float(score) or int(score)
-        ratings_descriptor.rate(request.user, score)
+        ratings_descriptor.upsert(request.user, score)
     else:
         ratings_descriptor.unrate(request.user)
 
+    return _rated_response(request, redirect_url)
+
+
+def _rated_response(request, redirect_url):
     if request.is_ajax():
         return HttpResponse('{"success": true}',
                             content_type='application/json')
     return HttpResponseRedirect(redirect_url)
+
+
+@login_required
+def rate_objects(request):
+    """
+    Stores a JSON array of {"ct": ..., "pk": ..., "score": ...} votes, a
+    score of null removing the rating.  The objects of each content type are
+    fetched with one query and the votes are written in one transaction.
+    Responds with a JSON array holding a result for each vote, in order.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        votes = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid JSON.')
+    if not isinstance(votes, list):
+        return HttpResponseBadRequest('Expected a JSON array of votes.')
+    if len(votes) > MAX_BATCH_SIZE:
+        return HttpResponseBadRequest('At most %d votes are accepted.' %
+                                      MAX_BATCH_SIZE)
+
+    results = [None] * len(votes)
+    # content type -> {object id: (index of the vote, score)}, the last vote
+    # for an object wins
+    by_ctype = {}
+    for i, vote in enumerate(votes):
+        try:
+            ctype, pk, score = _parse_vote(vote)
+        except ValueError, e:
+            results[i] = {'success': False, 'error': unicode(e)}
+            continue
+        previous = by_ctype.setdefault(ctype, {}).get(pk)
+        if previous is not None:
+            results[previous[0]] = {'success': True}
+        by_ctype[ctype][pk] = (i, score)
+
+    with atomic():
+        for ctype, objects in by_ctype.iteritems():
+            model_class = ctype.model_class()
+            instances = model_class._default_manager.in_bulk(objects.keys())
+            ratings = []
+            for pk, (i, score) in objects.iteritems():
+                obj = instances.get(pk)
+                if obj is None:
+                    results[i] = {'success': False,
+                                  'error': 'No object %s' % pk}
+                    continue
+                if BUFFER_VOTES:
+                    buffer_vote(ctype.pk, pk, request.user.pk, score)
+                elif score is None:
+                    getattr(obj, model_class._ratings_field).unrate(
+                        request.user)
+                else:
+                    ratings.append((obj, request.user, score))
+                results[i] = {'success': True}
+            if ratings:
+                getattr(model_class, model_class._ratings_field).rate_many(
+                    ratings)
+
+    return HttpResponse(json.dumps(results), content_type='application/json')
+
+
+def _parse_vote(vote):
+    """
+    Returns the content type, primary key and score of a vote, raising
+    ValueError when it is invalid
+    """
+    if (not isinstance(vote, dict) or
+            not set(['ct', 'pk', 'score']) <= set(vote)):
+        raise ValueError('Expected an object with ct, pk and score.')
+    try:
+        ctype = ContentType.objects.get_for_id(int(vote['ct']))
+    except (TypeError, ValueError, ContentType.DoesNotExist):
+        raise ValueError('No content type %s' % vote['ct'])
+    model_class = ctype.model_class()
+    if not hasattr(model_class, '_ratings_field'):
+        raise ValueError('Model class %s does not support ratings' %
+                         model_class)
+    try:
+        pk = model_class._meta.pk.to_python(vote['pk'])
+    except ValidationError:
+        raise ValueError('Invalid primary key: %s' % vote['pk'])
+    score = vote['score']
+    if score is not None and (isinstance(score, bool) or
+                              not isinstance(score, (int, long, float))):
+        raise ValueError('Invalid score: %s' % score)
+    return ctype, pk, score
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+import os
 import sys
+import tempfile
 import django
 
 from os.path import dirname, abspath
@@ -10,9 +12,13 @@ if len(sys.argv) > 1 and 'postgres' in sys.argv:
     sys.argv.remove('postgres')
     db_engine = 'django.db.backends.postgresql_psycopg2'
     db_name = 'test_main'
+    test_db_name = None
 else:
     db_engine = 'django.db.backends.sqlite3'
     db_name = ''
+    # a file rather than memory, so forked processes can open the test
+    # database over connections of their own
+    test_db_name = os.path.join(tempfile.gettempdir(), 'ratings_tests.db')
 
 if not settings.configured:
     settings.configure(
@@ -20,6 +26,7 @@ if not settings.configured:
             'default': {
                 'ENGINE': db_engine,
                 'NAME': db_name,
+                'TEST_NAME': test_db_name,
             }
         },
         DATABASE_ENGINE = db_engine,